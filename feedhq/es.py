@@ -1,3 +1,5 @@
+import hashlib
+import time
 from collections import defaultdict
 from contextlib import contextmanager
 from copy import deepcopy
@@ -6,13 +8,21 @@ from django.conf import settings
 from django.db import connection
 from django.http import Http404
 from elasticsearch import Elasticsearch, NotFoundError
-from elasticsearch.helpers import bulk as es_bulk, BulkIndexError
+from elasticsearch.helpers import (bulk as es_bulk, BulkIndexError,
+                                   scan as es_scan)
 
 
 client = Elasticsearch(settings.ES_NODES,
                        sniff_on_start=False,
                        sniff_on_connection_fail=True)
 
+# Number of hits per scroll page and bulk request when updating many
+# entries at once.
+SCAN_PAGE_SIZE = 500
+
+# Number of bodies loaded at once when streaming entries.
+CONTENT_CHUNK_SIZE = 20
+
 
 def user_alias(user_id):
     assert isinstance(user_id, int), repr(user_id)
@@ -23,6 +33,52 @@ def wait_for_yellow():
     return client.cluster.health(wait_for_status='yellow')
 
 
+class MappingError(Exception):
+    pass
+
+
+# Seconds after which a verified mapping is checked again
+MAPPING_CHECK_INTERVAL = 3600
+_mapping_verified_at = None
+
+
+def verify_mapping(force=False):
+    """
+    Makes sure guid and raw_title are not analyzed. Otherwise existing
+    entries are never matched by store_entries and things keep being
+    inserted.
+
+    The check result is cached for the lifetime of the process and only
+    re-done every MAPPING_CHECK_INTERVAL seconds.
+    """
+    global _mapping_verified_at
+    now = time.time()
+    if (
+        not force and
+        _mapping_verified_at is not None and
+        now - _mapping_verified_at < MAPPING_CHECK_INTERVAL
+    ):
+        return
+    mappings = client.indices.get_field_mapping(index=settings.ES_INDEX,
+                                                doc_type='entries',
+                                                field='guid,raw_title')
+    if not mappings:
+        raise MappingError("No mapping found for {0}".format(
+            settings.ES_INDEX))
+    for index, mapping in mappings.items():
+        fields = mapping['mappings'].get('entries', {})
+        for f in ['raw_title', 'guid']:
+            try:
+                analysis = fields[f]['mapping'][f].get('index')
+            except KeyError:
+                analysis = None
+            if analysis != 'not_analyzed':
+                raise MappingError(
+                    "Field '{0}' must be not_analyzed in {1}".format(
+                        f, index))
+    _mapping_verified_at = now
+
+
 def bulk(ops, **kwargs):
     """
     A wrapper for elasticsearch.helpers.bulk() that waits for a yellow
@@ -32,33 +88,203 @@ def bulk(ops, **kwargs):
     return es_bulk(client, ops, **kwargs)
 
 
-def counts(user, feed_ids, unread=True, stars=False):
-    aggs = {}
-    for pk in feed_ids:
-        term = {'term': {'feed': pk}}
-        if stars:
-            term = {'and': [
-                {'term': {'starred': True}},
-                term,
-            ]}
-        elif unread:
-            term = {'and': [
-                {'term': {'read': False}},
-                term,
-            ]}
-        aggs[pk] = {
-            'global': {},
-            'aggs': {
-                pk: {'filter': term},
+# Mapping of the shared content index. Sanitized variants are only stored,
+# sanitized_version tracks which sanitizer policy produced them. Bodies are
+# searchable through content.text, scoped to a user's feeds with url.raw.
+CONTENT_MAPPING = {
+    "_all": {"enabled": False},
+    "properties": {
+        "content": {
+            "type": "string",
+            "index": "no",
+            "fields": {
+                "text": {
+                    "type": "string",
+                },
             },
-        }
+        },
+        "url": {
+            "type": "string",
+            "index": "no",
+            "fields": {
+                "raw": {
+                    "type": "string",
+                    "index": "not_analyzed",
+                },
+            },
+        },
+        "sanitized": {
+            "type": "object",
+            "enabled": False,
+        },
+        "sanitized_version": {
+            "type": "integer",
+        },
+        "timestamp": {
+            "format": "dateOptionalTime",
+            "type": "date"
+        },
+    },
+}
+
+
+def content_id(feed_url, key):
+    """
+    Entry bodies are stored once per unique feed, in a shared index. Their
+    ID derives from the feed URL and the entry guid (or title, for feeds
+    reusing a single guid).
+    """
+    value = u'{0}\n{1}'.format(feed_url, key).encode('utf-8')
+    return hashlib.sha1(value).hexdigest()
+
+
+def contents(ids, fields=None):
+    """
+    Fetches entry bodies from the shared content index, as a dict of
+    content ID -> source. ``fields`` restricts the returned fields.
+    """
+    ids = list(set(ids))
+    if not ids:
+        return {}
+    params = {}
+    if fields:
+        params['_source_include'] = ','.join(fields)
+    docs = client.mget({'ids': ids}, index=settings.ES_CONTENT_INDEX,
+                       doc_type='content', params=params)['docs']
+    return {doc['_id']: doc['_source'] for doc in docs if doc['found']}
+
+
+def search_contents(feed_urls, query):
+    """
+    Returns the IDs of all the bodies of ``feed_urls`` matching ``query``.
+    Matches are scrolled SCAN_PAGE_SIZE at a time.
+    """
+    feed_urls = list(feed_urls)
+    if not feed_urls:
+        return []
+    hits = es_scan(client, query={
+        'query': {'filtered': {
+            'query': {'match': {'content.text': query}},
+            'filter': {'terms': {'url.raw': feed_urls}},
+        }},
+        '_source': False,
+    }, index=settings.ES_CONTENT_INDEX, doc_type='content',
+        size=SCAN_PAGE_SIZE)
+    return [hit['_id'] for hit in hits]
+
+
+def purge_contents(ids):
+    """
+    Deletes the given bodies from the shared content index unless an entry
+    still references them. Returns the number of deleted bodies.
+    """
+    ids = set(ids)
+    if not ids:
+        return 0
+    # Entries deleted just before must not be counted as references.
+    client.indices.refresh(settings.ES_INDEX)
+    referenced = set()
+    candidates = sorted(ids)
+    for start in range(0, len(candidates), SCAN_PAGE_SIZE):
+        chunk = candidates[start:start + SCAN_PAGE_SIZE]
+        results = client.search(index=settings.ES_INDEX, doc_type='entries',
+                                body={
+                                    'query': {'filtered': {'filter': {
+                                        'terms': {'content_id': chunk},
+                                    }}},
+                                    'aggs': {'contents': {'terms': {
+                                        'field': 'content_id',
+                                        'size': 0,
+                                    }}},
+                                }, params={'size': 0})
+        referenced.update(
+            bucket['key'] for bucket in
+            results['aggregations']['contents']['buckets'])
+    orphans = ids - referenced
+    ops = ({
+        '_op_type': 'delete',
+        '_index': settings.ES_CONTENT_INDEX,
+        '_type': 'content',
+        '_id': content_id,
+    } for content_id in orphans)
+    with ignore_bulk_error(404):
+        bulk(ops, chunk_size=SCAN_PAGE_SIZE, raise_on_error=True)
+    return len(orphans)
+
+
+def delete_entries(index, query):
+    """
+    Deletes the entries of ``index`` matching ``query``, and the shared
+    bodies no other entry references anymore.
+    """
+    hits = es_scan(client, query={'query': query,
+                                  '_source': ['content_id']},
+                   index=index, doc_type='entries', size=SCAN_PAGE_SIZE)
+    ids = set(hit['_source']['content_id'] for hit in hits
+              if hit['_source'].get('content_id'))
+    result = client.delete_by_query(index=index, doc_type='entries',
+                                    body={'query': query})
+    purge_contents(ids)
+    return result
+
+
+def join_contents(entries):
+    """
+    Loads the bodies of a list of entries in a single round trip. Sanitized
+    variants are left out, they're only needed when displaying a single
+    entry.
+    """
+    pending = [entry for entry in entries if entry.content_pending]
+    if not pending:
+        return entries
+    sources = contents([entry.content_id for entry in pending],
+                       fields=['content'])
+    for entry in pending:
+        entry.load_content(sources.get(entry.content_id, {}))
+    return entries
+
+
+def iter_contents(entries, chunk_size=CONTENT_CHUNK_SIZE):
+    """
+    Yields entries with their bodies, loaded ``chunk_size`` at a time.
+    Entries are removed from the list as they're yielded so that only one
+    chunk of bodies is held in memory.
+    """
+    while entries:
+        chunk = entries[:chunk_size]
+        del entries[:chunk_size]
+        yield from join_contents(chunk)
+
+
+def counts(user, feed_ids, unread=True, stars=False):
+    """
+    Returns the number of (unread, starred or all) entries per feed ID.
+    Feeds without entries map to 0.
+    """
+    feed_ids = list(feed_ids)
+    result = defaultdict(int)
+    if not feed_ids:
+        return result
+    filters = [{'terms': {'feed': feed_ids}}]
+    if stars:
+        filters.append({'term': {'starred': True}})
+    elif unread:
+        filters.append({'term': {'read': False}})
     query = {
-        'aggs': aggs,
+        'query': {'filtered': {'filter': {'and': filters}}},
+        'aggs': {
+            'feeds': {'terms': {'field': 'feed', 'size': 0}},
+        },
     }
-    return client.search(index=user_alias(user.pk),
-                         doc_type='entries',
-                         body=query,
-                         params={'size': 0}).get('aggregations', {})
+    results = client.search(index=user_alias(user.pk),
+                            doc_type='entries',
+                            body=query,
+                            params={'size': 0})
+    buckets = results.get('aggregations', {}).get(
+        'feeds', {}).get('buckets', [])
+    for bucket in buckets:
+        result[bucket['key']] = bucket['doc_count']
+    return result
 
 
 def entry(user, id, annotate_results=True):
@@ -76,7 +302,11 @@ def entry(user, id, annotate_results=True):
     return entry
 
 
-def mget(user, pks, annotate_results=True):
+def mget(user, pks, annotate_results=True, contents=True):
+    """
+    Fetches entries by ID. With ``contents=False``, bodies from the shared
+    content index are left for iter_contents() to load.
+    """
     from .feeds.models import EsEntry
     docs = client.mget({'ids': pks}, index=user_alias(user.pk),
                        doc_type='entries')['docs']
@@ -92,11 +322,32 @@ def mget(user, pks, annotate_results=True):
             continue
         doc['_id'] = int(doc['_id'])
         results.append(EsEntry(doc))
+    if contents:
+        join_contents(results)
     if annotate_results:
         results = _annotate(results, user)
     return results
 
 
+def unread_deltas(user, pks, read):
+    """
+    Returns the {feed_id: delta} changes to apply to the unread counters
+    when setting ``read`` on the given entries.
+    """
+    deltas = defaultdict(int)
+    if not pks:
+        return deltas
+    docs = client.mget({'ids': pks}, index=user_alias(user.pk),
+                       doc_type='entries',
+                       params={'_source_include': 'feed,read,user'})['docs']
+    for doc in docs:
+        if not doc['found'] or doc['_source']['user'] != user.pk:
+            continue
+        if doc['_source']['read'] != read:
+            deltas[doc['_source']['feed']] += -1 if read else 1
+    return deltas
+
+
 def _annotate(results, user):
     feed_ids = set([e.feed for e in results])
     if not feed_ids:
@@ -119,14 +370,23 @@ def _annotate(results, user):
     return annotated
 
 
-def next_id():
+def next_ids(count):
+    """
+    Allocates ``count`` entry IDs in a single round trip. IDs are
+    increasing within a block, which keeps the ``id:desc`` tiebreak ordering
+    stable for entries sharing a timestamp.
+    """
+    if count <= 0:
+        return []
     cursor = connection.cursor()
     try:
-        cursor.execute("select nextval('feeds_entry_id_seq'::regclass)")
-        [(value,)] = cursor.fetchall()
+        cursor.execute(
+            "select nextval('feeds_entry_id_seq'::regclass) "
+            "from generate_series(1, %s)", [count])
+        values = sorted(value for (value,) in cursor.fetchall())
     finally:
         cursor.close()
-    return value
+    return values
 
 
 def _and_or_term(values):
@@ -158,6 +418,7 @@ def _lookup(name, lk):
 class EntryQuery(object):
     def __init__(self, **kwargs):
         self.indices = ''
+        self.user_id = None
         self.filters = {}
         self.aggs = {}
         self.terms_aggs = {}
@@ -171,6 +432,7 @@ class EntryQuery(object):
     def _clone(self):
         q = self.__class__()
         q.indices = self.indices
+        q.user_id = self.user_id
         q.filters = deepcopy(self.filters)
         q.aggs = deepcopy(self.aggs)
         q.terms_aggs = deepcopy(self.terms_aggs)
@@ -179,6 +441,9 @@ class EntryQuery(object):
         q.query = self.query
         q.source = deepcopy(self.source)
         q.ordering = self.ordering
+        if hasattr(self, '_content_key'):
+            q._content_key = self._content_key
+            q._content_ids = self._content_ids
         return q
 
     def filter(self, clone=True, or_=False, **kwargs):
@@ -204,6 +469,7 @@ class EntryQuery(object):
                 if negate:
                     raise ValueError("Can't exclude an index.")
                 self.indices = user_alias(value)
+                self.user_id = value
                 continue
 
             if key == 'query':
@@ -234,14 +500,23 @@ class EntryQuery(object):
 
     def defer(self, *fields):
         q = self._clone()
+        if 'content' in fields:
+            fields += ('content_id',)
         q.source['exclude'] = fields
         return q
 
     def only(self, *fields):
         q = self._clone()
+        if 'content' in fields:
+            fields += ('content_id',)
         q.source['include'] = fields
         return q
 
+    def _wants_content(self):
+        if 'include' in self.source:
+            return 'content' in self.source['include']
+        return 'content' not in self.source.get('exclude', ())
+
     def aggregate(self, name, **kwargs):
         """
         Add an aggregation to the current query.
@@ -300,14 +575,120 @@ class EntryQuery(object):
             q.ordering.append('{0}:{1}'.format(crit, order))
         return q
 
-    def fetch(self, page=1, per_page=50, annotate=None):
-        from .feeds.models import EsEntry
+    def _filtered(self):
         filters = {}
         if self.filters:
             filters['filter'] = _and_or_term(list(self.filters.values()))
         else:
             filters['filter'] = {'match_all': {}}
 
+        if self.query:
+            filters['query'] = {'match': {'_all': self.query}}
+            content_ids = self._content_matches()
+            if content_ids:
+                # A filter, unlike a terms query, isn't limited to 1024
+                # clauses.
+                filters['query'] = {'bool': {'should': [
+                    filters['query'],
+                    {'constant_score': {'filter': {
+                        'terms': {'content_id': content_ids},
+                    }}},
+                ]}}
+        return filters
+
+    def _content_matches(self):
+        """
+        Bodies live in the shared content index, they're searched
+        separately and joined to the entries through content_id.
+        """
+        if self.user_id is None:
+            return []
+        key = (self.user_id, self.query)
+        if getattr(self, '_content_key', None) != key:
+            from .feeds.models import Feed
+            urls = Feed.objects.filter(user_id=self.user_id).values_list(
+                'url', flat=True).distinct()
+            self._content_ids = search_contents(urls, self.query)
+            self._content_key = key
+        return self._content_ids
+
+    def scan(self, *fields):
+        """
+        Iterates over all the matching entries with a scroll, fetching
+        SCAN_PAGE_SIZE hits at a time. Only ``fields`` are loaded from the
+        source.
+        """
+        query = {
+            'query': {'filtered': self._filtered()},
+            '_source': list(fields) if fields else False,
+        }
+        return es_scan(client, query=query, index=self.indices,
+                       doc_type='entries', size=SCAN_PAGE_SIZE)
+
+    def update(self, doc, fields=(), callback=None, refresh=True):
+        """
+        Applies a partial update to all the matching entries. IDs are
+        streamed from a scroll to the bulk API, so memory use doesn't depend
+        on the number of matches.
+
+        ``callback`` is called with each hit, which contains ``fields``.
+        """
+        def ops():
+            for hit in self.scan(*fields):
+                if callback is not None:
+                    callback(hit)
+                yield {
+                    '_op_type': 'update',
+                    '_index': self.indices,
+                    '_type': 'entries',
+                    '_id': hit['_id'],
+                    'doc': doc,
+                }
+        with ignore_bulk_error(404, 409):
+            bulk(ops(), chunk_size=SCAN_PAGE_SIZE, raise_on_error=True)
+        if refresh:
+            client.indices.refresh(self.indices)
+
+    def search_after(self, values):
+        """
+        Only returns entries sorting strictly after ``values`` (the sort
+        values of the last hit of the previous page) in the current
+        ordering.
+
+        ES 1.x has no search_after, it is emulated with range filters:
+        (a < x) or (a = x and b < y) for a descending ordering on (a, b).
+        Resuming this way costs the same at any depth, unlike from/size.
+        """
+        if len(values) != len(self.ordering):
+            raise ValueError("Expected {0} sort values".format(
+                len(self.ordering)))
+        q = self._clone()
+        clauses = []
+        previous = []
+        for crit, value in zip(self.ordering, values):
+            name, order = crit.split(':')
+            lookup = 'lt' if order == 'desc' else 'gt'
+            clauses.append(_and_or_term(previous + [
+                {'range': {name: {lookup: value}}},
+            ]))
+            previous.append({'term': {name: value}})
+        # Not keyed by field name, so that it doesn't replace other
+        # timestamp or id filters.
+        q.filters['__after__'] = (
+            clauses[0] if len(clauses) == 1 else {'or': clauses})
+        return q
+
+    def fetch(self, page=1, per_page=50, annotate=None, has_more=False,
+              contents=True):
+        """
+        Runs the query. With ``has_more``, one extra hit is requested to
+        tell whether another page exists (``results['has_more']``) without
+        counting all the matches. With ``contents=False``, bodies from the
+        shared content index are left for iter_contents() to load.
+        """
+        from .feeds.models import EsEntry
+        filters = self._filtered()
+
         if self.terms_aggs or self.query_agg:
             self.aggs['query'] = {'filter': filters['filter']}
             if self.terms_aggs:
@@ -316,9 +697,6 @@ class EntryQuery(object):
         if self.query_aggs:
             self.aggs.update(self.query_aggs)
 
-        if self.query:
-            filters['query'] = query = {'match': {'_all': self.query}}
-
         query = {}
 
         if filters:
@@ -342,10 +720,18 @@ class EntryQuery(object):
             params={
                 'from': (page - 1) * per_page,
                 'sort': ",".join(self.ordering),
-                'size': per_page,
+                'size': per_page + 1 if has_more else per_page,
             },
         )
-        results['hits'] = [EsEntry(hit) for hit in results['hits']['hits']]
+        hits = results['hits']['hits']
+        if has_more:
+            results['has_more'] = len(hits) > per_page
+            hits = hits[:per_page]
+        # Sort values of the last hit, to resume with search_after().
+        results['last_sort'] = hits[-1].get('sort') if hits else None
+        results['hits'] = [EsEntry(hit) for hit in hits]
+        if contents and self._wants_content():
+            join_contents(results['hits'])
         if annotate is not None:
             results['hits'] = _annotate(results['hits'], annotate)
         return results
@@ -367,5 +753,7 @@ def ignore_bulk_error(*statuses):
         yield
     except BulkIndexError as e:
         for doc in e.args[1]:
-            if doc['update']['status'] not in statuses:
+            # Errors are keyed by operation type (update, delete...)
+            [result] = doc.values()
+            if result['status'] not in statuses:
                 raise
@@ -48,6 +48,9 @@ class UniqueFeedAdmin(ModelAdmin):
     list_filter = ('muted', 'error')
     search_fields = ('url',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_job_details()
+
     class Media:
         js = (
             'feeds/js/d3.v3.min.js',
@@ -0,0 +1,207 @@
+"""
+Concurrent feed fetching.
+
+Pulls due jobs from the scheduler and runs many feed updates at once in a
+pool of threads. Each fetch goes through the same code path as the
+``update_feed`` RQ task so status codes, backoff, redirections and
+conditional requests behave identically.
+
+Jobs are grouped by host: each host gets a keep-alive session, a cap on
+simultaneous requests and a token bucket limiting its request rate. Jobs not
+started before the run's deadline are handed back to the scheduler.
+"""
+import threading
+import time
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
+
+import requests
+import structlog
+from django.db import connections
+from rache import pending_jobs, schedule_job
+from requests.adapters import HTTPAdapter
+from six.moves.urllib import parse as urlparse
+
+from .models import UniqueFeed
+from .tasks import update_feed
+from ..utils import get_redis_connection
+
+logger = structlog.get_logger(__name__)
+
+
+def due_jobs(limit):
+    """
+    Pops up to ``limit`` due jobs from the scheduler. Jobs are
+    rescheduled one UPDATE_PERIOD away in case the fetch never completes.
+    """
+    jobs = pending_jobs(limit=limit,
+                        reschedule_in=UniqueFeed.UPDATE_PERIOD * 60,
+                        connection=get_redis_connection())
+    for job in jobs:
+        url = job.pop('id')
+        job.pop('last_update', None)
+        yield url, job
+
+
+def url_host(url):
+    try:
+        return (urlparse.urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return ''
+
+
+class TokenBucket(object):
+    """Allows ``rate`` requests per second, with bursts of ``burst``."""
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how long to wait (in seconds) before
+        using it.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def take(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class Host(object):
+    """Jobs, session and rate limit of a single host."""
+    def __init__(self, name, per_host, rate, burst):
+        self.name = name
+        self.jobs = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+
+def run_deadline():
+    """
+    Popped jobs come back after UPDATE_PERIOD. Runs stop well before that
+    so slow hosts don't get the same feeds fetched twice.
+    """
+    return UniqueFeed.UPDATE_PERIOD * 60 // 2
+
+
+class Fetcher(object):
+    def __init__(self, concurrency=100, per_host=2, host_rate=5,
+                 host_burst=10, deadline=None):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.deadline = deadline
+        self.stop_at = None
+
+    def hosts(self, jobs):
+        hosts = OrderedDict()
+        for url, job in jobs:
+            name = url_host(url)
+            if name not in hosts:
+                hosts[name] = Host(name, self.per_host, self.host_rate,
+                                   self.host_burst)
+            hosts[name].jobs.append((url, job))
+        return hosts
+
+    def lanes(self, hosts):
+        """
+        Up to ``per_host`` lanes per host, each fetching the host's jobs one
+        after the other. Lanes are interleaved so that busy hosts don't
+        hold every thread.
+        """
+        lanes = defaultdict(list)
+        for host in hosts.values():
+            for index in range(min(self.per_host, len(host.jobs))):
+                lanes[index].append(host)
+        return [host for index in sorted(lanes) for host in lanes[index]]
+
+    def fetch(self, url, job, session=None):
+        try:
+            update_feed(url, session=session, **job)
+        except Exception as e:
+            # update_feed already logs fatal exceptions. Don't let a single
+            # feed take the whole batch down.
+            logger.info("fetch failed", url=url, exc_info=e)
+            return False
+        return True
+
+    def expired(self):
+        return self.stop_at is not None and time.monotonic() >= self.stop_at
+
+    def drain(self, host):
+        count = errors = 0
+        try:
+            while True:
+                try:
+                    url, job = host.jobs.popleft()
+                except IndexError:
+                    break
+                host.bucket.take()
+                if self.expired():
+                    host.jobs.appendleft((url, job))
+                    break
+                count += 1
+                if not self.fetch(url, job, session=host.session):
+                    errors += 1
+        finally:
+            # Threads get their own DB connections, don't leak them.
+            connections.close_all()
+        return count, errors
+
+    def give_back(self, hosts):
+        """
+        Reschedules the jobs left unstarted when the deadline passed or the
+        run failed.
+        """
+        redis = get_redis_connection()
+        count = 0
+        for host in hosts.values():
+            for url, _job in host.jobs:
+                schedule_job(url, schedule_in=0, connection=redis)
+                count += 1
+        return count
+
+    def run(self, jobs):
+        start = time.time()
+        count = errors = 0
+        hosts = self.hosts(jobs)
+        if self.deadline is not None:
+            self.stop_at = time.monotonic() + self.deadline
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = [executor.submit(self.drain, host)
+                           for host in self.lanes(hosts)]
+                for future in as_completed(futures):
+                    fetched, failed = future.result()
+                    count += fetched
+                    errors += failed
+        finally:
+            for host in hosts.values():
+                host.close()
+            returned = self.give_back(hosts)
+        elapsed = time.time() - start
+        logger.info("fetched feeds", count=count, errors=errors,
+                    returned=returned, hosts=len(hosts),
+                    concurrency=self.concurrency, elapsed=round(elapsed, 2))
+        return count
@@ -1,6 +1,7 @@
 import contextlib
 import json
 import os
+from collections import defaultdict
 
 import feedparser
 import floppyforms.__future__ as forms
@@ -168,20 +169,8 @@ class FeedForm(UserFormMixin, forms.ModelForm):
             feed.tracker.has_changed('category_id') and
             feed.tracker.previous('id')
         ):
-            new_cat = feed.category_id
-            entries = es.manager.user(self.user).filter(
-                feed=feed.pk).aggregate('id').fetch(per_page=0)
-            pks = [bucket['key'] for bucket in entries[
-                'aggregations']['entries']['query']['id']['buckets']]
-            if pks:
-                ops = [{
-                    '_op_type': 'update',
-                    '_type': 'entries',
-                    '_id': pk,
-                    'doc': {'category': new_cat},
-                } for pk in pks]
-                index = es.user_alias(self.user.pk)
-                es.bulk(ops, index=index, raise_on_error=True)
+            es.manager.user(self.user).filter(feed=feed.pk).update(
+                {'category': feed.category_id}, refresh=False)
         feed.save()
         return feed
 
@@ -249,19 +238,26 @@ class ReadForm(forms.Form):
         return json.loads(self.cleaned_data['entries'])
 
     def save(self):
-        index = es.user_alias(self.user.pk)
-        if self.pages_only:
-            pks = self.cleaned_data['entries']
-        else:
-            # Fetch all IDs for current query.
-            entries = self.es_entries.filter(
-                read=False).aggregate('id').fetch(per_page=0)
-            pks = [bucket['key'] for bucket in entries[
-                'aggregations']['entries']['query']['id']['buckets']]
-
+        if not self.pages_only:
+            # Walk all the unread entries of the current query. IDs are
+            # kept for the undo form.
+            pks = []
+            deltas = defaultdict(int)
+
+            def collect(hit):
+                pks.append(int(hit['_id']))
+                deltas[hit['_source']['feed']] -= 1
+
+            self.es_entries.filter(read=False).update(
+                {'read': True}, fields=['feed'], callback=collect)
+            self.user.incr_unread_counts(deltas)
+            return pks
+
+        pks = self.cleaned_data['entries']
+        deltas = es.unread_deltas(self.user, pks, True)
         ops = [{
             '_op_type': 'update',
-            '_index': index,
+            '_index': es.user_alias(self.user.pk),
             '_type': 'entries',
             '_id': pk,
             'doc': {'read': True},
@@ -269,6 +265,7 @@ class ReadForm(forms.Form):
         if pks:
             with es.ignore_bulk_error(404, 409):
                 es.bulk(ops, raise_on_error=True, params={'refresh': True})
+            self.user.incr_unread_counts(deltas)
         return pks
 
 
@@ -292,6 +289,7 @@ class UndoReadForm(forms.Form):
     def save(self):
         pks = self.cleaned_data['pks']
         index = es.user_alias(self.user.pk)
+        deltas = es.unread_deltas(self.user, pks, False)
         ops = [{
             '_op_type': 'update',
             '_index': index,
@@ -301,6 +299,7 @@ class UndoReadForm(forms.Form):
         } for pk in pks]
         with es.ignore_bulk_error(404, 409):
             es.bulk(ops, raise_on_error=True, params={'refresh': True})
+        self.user.incr_unread_counts(deltas)
         return len(pks)
 
 
@@ -0,0 +1,238 @@
+import os
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from unittest import mock
+
+import feedparser
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from six.moves.urllib import parse as urlparse
+
+from ...models import Feed, UniqueFeed
+from ...tasks import forget_seen, store_entries
+from ...utils import delete_jobs
+from ....profiles.models import User
+
+CORPUS = os.path.join(os.path.dirname(settings.BASE_DIR), 'tests', 'data')
+FEED_EXTENSIONS = ('.xml', '.atom', '.rss')
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+
+def remote_services():
+    """Names of the configured services not running on this machine."""
+    hosts = [('database', settings.DATABASES['default'].get('HOST'))]
+    for node in settings.ES_NODES:
+        if '//' not in node:
+            node = '//' + node
+        hosts.append(('elasticsearch', urlparse.urlsplit(node).hostname))
+    # Unix sockets have no host
+    hosts.append(('redis', settings.REDIS.get('host')))
+    return sorted(set(name for name, host in hosts
+                      if (host or '') not in LOCAL_HOSTS))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Stages(object):
+    """Collects timings and allocations for each stage of the pipeline."""
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self.timings = defaultdict(list)
+        self.allocated = defaultdict(list)
+
+    @contextmanager
+    def measure(self, stage):
+        if self.allocations:
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage].append(time.perf_counter() - start)
+            if self.allocations:
+                self.allocated[stage].append(
+                    tracemalloc.get_traced_memory()[0] - before)
+
+    def wrap(self, stage, func):
+        def wrapped(*args, **kwargs):
+            with self.measure(stage):
+                return func(*args, **kwargs)
+        return wrapped
+
+
+class StoreJobs(list):
+    """Collects the store jobs update_feed enqueues."""
+    def enqueue(self, func, args=None, kwargs=None, **job_options):
+        if func is store_entries:
+            self.append((args, kwargs or {}))
+
+
+def recorded_response(url, content):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['Content-Type'] = 'text/xml'
+    response._content = content
+    response._content_consumed = True
+    return response
+
+
+def resolved_link(url, *args, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    return response
+
+
+class Command(BaseCommand):
+    """Replays recorded feeds through the ingestion pipeline:
+    update_feed (fetch + parse + entry_data) then store_entries, and reports
+    throughput and per-stage latencies.
+
+    HTTP is replaced by the recorded files. Storage goes to the configured
+    database, Elasticsearch and Redis, which must be local instances unless
+    DEBUG is on: subscribers are temporary users that get deleted along with
+    their entries.
+    """
+    help = "Benchmarks feed ingestion using recorded feeds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='Feed files to replay (default: the test '
+                                 'fixtures)')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=5,
+                            help='Number of times the corpus is replayed')
+        parser.add_argument('--subscribers', dest='subscribers', type=int,
+                            default=1,
+                            help='Number of subscribers per feed. 0 skips '
+                                 'indexing entirely')
+        parser.add_argument('--fresh', dest='fresh', action='store_true',
+                            default=False,
+                            help='Forget seen entries before each round so '
+                                 'that every round goes through indexing')
+        parser.add_argument('--allocations', dest='allocations',
+                            action='store_true', default=False,
+                            help='Trace memory allocations (slower)')
+
+    def corpus(self, paths):
+        if not paths:
+            paths = [os.path.join(CORPUS, name)
+                     for name in sorted(os.listdir(CORPUS))
+                     if name.endswith(FEED_EXTENSIONS)]
+        corpus = []
+        for path in paths:
+            if not os.path.isfile(path):
+                raise CommandError("{0} is not a file".format(path))
+            with open(path, 'rb') as f:
+                name = os.path.basename(path)
+                url = 'http://bench-{0}.invalid/{1}'.format(
+                    uuid.uuid4().hex[:8], name)
+                corpus.append((url, f.read()))
+        return corpus
+
+    def subscribe(self, urls, subscribers, users):
+        """Creates ``subscribers`` temporary users, appended to ``users``."""
+        for _ in range(subscribers):
+            name = 'bench-{0}'.format(uuid.uuid4().hex[:12])
+            users.append(User.objects.create(
+                username=name, email='{0}@bench.invalid'.format(name)))
+        # bulk_create skips Feed.save(), which would enqueue real fetches.
+        Feed.objects.bulk_create([Feed(name=url, url=url, user=user)
+                                  for user in users for url in urls])
+
+    def cleanup(self, urls, users):
+        for user in users:
+            pks = list(user.feeds.values_list('pk', flat=True))
+            if pks:
+                user.delete_feed_entries(*pks)
+            user.reset_unread_counts()
+            user.delete()
+        UniqueFeed.objects.filter(url__in=urls).delete()
+        delete_jobs(urls)
+        for url in urls:
+            forget_seen(url)
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            remote = remote_services()
+            if remote:
+                raise CommandError(
+                    "Refusing to write benchmark data to non-local services "
+                    "({0}) with DEBUG off".format(', '.join(remote)))
+        corpus = self.corpus(options['paths'])
+        if not corpus:
+            raise CommandError("No feeds to replay")
+        urls = [url for url, content in corpus]
+        stages = Stages(allocations=options['allocations'])
+        feed_count = entry_count = 0
+
+        users = []
+        try:
+            self.subscribe(urls, options['subscribers'], users)
+            if options['allocations']:
+                tracemalloc.start()
+            start = time.perf_counter()
+            for _ in range(options['rounds']):
+                if options['fresh']:
+                    for url in urls:
+                        forget_seen(url)
+                for url, content in corpus:
+                    jobs = StoreJobs()
+                    with mock.patch('requests.get') as get, \
+                            mock.patch('requests.head',
+                                       side_effect=resolved_link), \
+                            mock.patch('feedhq.feeds.models.enqueue',
+                                       side_effect=jobs.enqueue), \
+                            mock.patch.object(
+                                feedparser, 'parse',
+                                stages.wrap('parse', feedparser.parse)), \
+                            mock.patch.object(
+                                UniqueFeed.objects, 'entry_data',
+                                stages.wrap('entry_data',
+                                            UniqueFeed.objects.entry_data)):
+                        get.return_value = recorded_response(url, content)
+                        with stages.measure('update_feed'):
+                            UniqueFeed.objects.update_feed(url)
+                    feed_count += 1
+
+                    for (feed_url, entries), kwargs in jobs:
+                        entry_count += len(entries)
+                        if options['subscribers']:
+                            with stages.measure('store_entries'):
+                                store_entries(feed_url, entries, **kwargs)
+            elapsed = time.perf_counter() - start
+            if options['allocations']:
+                peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if options['allocations']:
+                tracemalloc.stop()
+            self.cleanup(urls, users)
+
+        self.stdout.write(
+            "{0} feeds, {1} entries in {2:.2f}s: {3:.1f} feeds/s, "
+            "{4:.1f} entries/s".format(
+                feed_count, entry_count, elapsed, feed_count / elapsed,
+                entry_count / elapsed))
+        for stage in ['update_feed', 'parse', 'entry_data', 'store_entries']:
+            timings = stages.timings[stage]
+            if not timings:
+                continue
+            line = "{0:<14} n={1:<6} p50={2:8.2f}ms p99={3:8.2f}ms".format(
+                stage, len(timings), percentile(timings, 50) * 1000,
+                percentile(timings, 99) * 1000)
+            if options['allocations']:
+                allocated = stages.allocated[stage]
+                line += " alloc p50={0:.1f}kB".format(
+                    percentile(allocated, 50) / 1024)
+            self.stdout.write(line)
+        if options['allocations']:
+            self.stdout.write("peak traced memory: {0:.1f}kB".format(
+                peak / 1024))
@@ -32,6 +32,10 @@ class Command(BaseCommand):
                             "type": "string",
                             "index": "not_analyzed",
                         },
+                        "content_id": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
                         "user": {
                             "type": "long",
                         },
@@ -42,3 +46,15 @@ class Command(BaseCommand):
                 },
             },
         })
+        es.client.indices.create(settings.ES_CONTENT_INDEX, body={
+            'settings': {
+                'index': {
+                    'number_of_shards': settings.ES_SHARDS,
+                    'number_of_replicas': settings.ES_REPLICAS,
+                },
+            },
+            'mappings': {
+                "content": es.CONTENT_MAPPING,
+            },
+        })
+        es.verify_mapping(force=True)
@@ -0,0 +1,40 @@
+from . import SentryCommand
+from ...fetcher import due_jobs, Fetcher, run_deadline
+from ...utils import update_limit
+
+
+class Command(SentryCommand):
+    help = "Fetches due feeds concurrently, without going through RQ"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', dest='concurrency', type=int,
+                            default=100,
+                            help='Number of feeds fetched simultaneously')
+        parser.add_argument('--limit', dest='limit', type=int, default=None,
+                            help='Maximum number of feeds to fetch')
+        parser.add_argument('--per-host', dest='per_host', type=int,
+                            default=2,
+                            help='Number of feeds fetched simultaneously '
+                                 'from a single host')
+        parser.add_argument('--host-rate', dest='host_rate', type=float,
+                            default=5,
+                            help='Maximum number of requests per second to '
+                                 'a single host')
+        parser.add_argument('--deadline', dest='deadline', type=int,
+                            default=None,
+                            help='Seconds after which feeds not fetched yet '
+                                 'are handed back to the scheduler. Defaults '
+                                 'to half the update period.')
+
+    def handle_sentry(self, *args, **options):
+        limit = options['limit']
+        if limit is None:
+            limit = update_limit()
+        deadline = options['deadline']
+        if deadline is None:
+            deadline = run_deadline()
+        fetcher = Fetcher(concurrency=options['concurrency'],
+                          per_host=options['per_host'],
+                          host_rate=options['host_rate'],
+                          deadline=deadline)
+        fetcher.run(due_jobs(limit))
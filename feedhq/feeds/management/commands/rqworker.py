@@ -5,6 +5,7 @@ from rq import Connection, Queue, Worker
 from structlog import get_logger
 
 from . import SentryCommand
+from .... import es
 from ....utils import get_redis_connection
 
 logger = get_logger(__name__)
@@ -40,6 +41,9 @@ class Command(SentryCommand):
                             help='Run the worker in burst mode')
 
     def handle_sentry(self, *args, **options):
+        if 'store' in options['queues']:
+            # Fail early rather than storing duplicates
+            es.verify_mapping(force=True)
         conn = get_redis_connection()
         with Connection(conn):
             queues = map(Queue, options['queues'])
@@ -0,0 +1,77 @@
+import structlog
+from django.conf import settings
+from django.core.management.base import CommandError
+from elasticsearch.helpers import scan
+
+from . import SentryCommand
+from ...models import BaseEntry
+from .... import es
+
+logger = structlog.get_logger(__name__)
+
+
+class Command(SentryCommand):
+    """Renders the sanitized variants of stored entry bodies that were
+    produced by an older sanitizer version (or none at all)."""
+    help = "Re-sanitizes stored entry bodies with the current policies"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', dest='all', action='store_true',
+                            default=False,
+                            help='Re-sanitize every body, not only outdated '
+                                 'ones')
+
+    def handle_sentry(self, *args, **options):
+        # Adds the fields (and search sub-fields) to indices created before
+        # they existed.
+        es.client.indices.put_mapping(index=settings.ES_CONTENT_INDEX,
+                                      doc_type='content',
+                                      body={'content': es.CONTENT_MAPPING})
+        if options['all']:
+            query = {'match_all': {}}
+        else:
+            query = {'filtered': {'filter': {'bool': {'must_not': {
+                'term': {'sanitized_version': BaseEntry.SANITIZE_VERSION},
+            }}}}}
+        hits = scan(es.client, query={'query': query,
+                                      '_source': ['content', 'url']},
+                    index=settings.ES_CONTENT_INDEX, doc_type='content',
+                    size=es.SCAN_PAGE_SIZE)
+
+        skipped = 0
+
+        def ops():
+            nonlocal skipped
+            for hit in hits:
+                source = hit['_source']
+                if not source.get('url'):
+                    # Stored before base URLs were: links can't be made
+                    # absolute, these keep being sanitized when displayed.
+                    skipped += 1
+                    continue
+                doc = BaseEntry.stored_content(source.get('content', ''),
+                                               source['url'])
+                if 'sanitized' not in doc:
+                    skipped += 1
+                    continue
+                yield {
+                    '_op_type': 'update',
+                    '_index': settings.ES_CONTENT_INDEX,
+                    '_type': 'content',
+                    '_id': hit['_id'],
+                    'doc': {
+                        'sanitized': doc['sanitized'],
+                        'sanitized_version': doc['sanitized_version'],
+                    },
+                }
+        # Bodies purged during the scan fail to update: keep going and
+        # report failures once the rest is done. Failed bodies keep their
+        # old version and are picked up by the next run.
+        updated, errors = es.bulk(ops(), chunk_size=es.SCAN_PAGE_SIZE,
+                                  raise_on_error=False)
+        logger.info("sanitized contents", updated=updated, skipped=skipped,
+                    failed=len(errors), version=BaseEntry.SANITIZE_VERSION)
+        if errors:
+            raise CommandError(
+                "Failed to update {0} bodies, first error: {1}".format(
+                    len(errors), errors[0]))
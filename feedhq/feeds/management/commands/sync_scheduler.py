@@ -1,9 +1,10 @@
 import structlog
 from more_itertools import chunked
-from rache import delete_job, scheduled_jobs
+from rache import scheduled_jobs
 
 from . import SentryCommand
 from ...models import UniqueFeed
+from ...utils import delete_jobs
 from ....utils import get_redis_connection
 
 logger = structlog.get_logger(__name__)
@@ -26,13 +27,12 @@ class Command(SentryCommand):
         if to_delete:
             logger.info("deleting jobs from the scheduler",
                         count=len(to_delete))
-            for job_id in to_delete:
-                delete_job(job_id, connection=connection)
+            for chunk in chunked(to_delete, 10000):
+                delete_jobs(chunk)
 
         to_add = target - existing_jobs
         if to_add:
             logger.info("adding jobs to the scheduler", count=len(to_add))
             for chunk in chunked(to_add, 10000):
-                uniques = UniqueFeed.objects.filter(url__in=chunk)
-                for unique in uniques:
-                    unique.schedule()
+                UniqueFeed.objects.bulk_schedule(
+                    UniqueFeed.objects.filter(url__in=chunk))
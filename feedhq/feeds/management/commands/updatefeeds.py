@@ -5,6 +5,7 @@ from rq import Queue
 from . import SentryCommand
 from ...models import UniqueFeed
 from ...tasks import update_feed
+from ...utils import update_limit
 from ....tasks import enqueue
 from ....utils import get_redis_connection
 
@@ -27,12 +28,10 @@ class Command(SentryCommand):
                 subscribers=data.get('subscribers', 1),
                 backoff_factor=data['backoff_factor'], error=data.get('error'),
                 link=data.get('link'), title=data.get('title'),
-                hub=data.get('hub'),
+                hub=data.get('hub'), arrivals=data.get('arrivals'),
             )
 
-        ratio = UniqueFeed.UPDATE_PERIOD // 5
-        limit = max(
-            1, UniqueFeed.objects.filter(muted=False).count() // ratio) * 2
+        limit = update_limit()
 
         # Avoid queueing if the default or store queue is already full
         conn = get_redis_connection()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0002_auto_20150709_0804'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uniquefeed',
+            name='error',
+            field=models.CharField(max_length=50, db_column='muted_reason', null=True, verbose_name='Error', blank=True, choices=[('gone', 'Feed gone (410)'), ('timeout', 'Feed timed out'), ('parseerror', 'Location parse error'), ('connerror', 'Connection error'), ('decodeerror', 'Decoding error'), ('notafeed', 'Not a valid RSS/Atom feed'), ('toolarge', 'Feed too large'), ('unexpectedcontent', 'Unexpected content (not XML)'), ('400', 'HTTP 400'), ('401', 'HTTP 401'), ('403', 'HTTP 403'), ('404', 'HTTP 404'), ('500', 'HTTP 500'), ('502', 'HTTP 502'), ('503', 'HTTP 503')]),
+        ),
+    ]
@@ -3,6 +3,7 @@ import base64
 import datetime
 import hashlib
 import json
+import math
 import random
 import socket
 import struct
@@ -20,7 +21,8 @@ from django.conf import settings
 from django.core.cache import cache
 from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.db import models
+from django.db import models, transaction
+from django.db.models.query import ModelIterable
 from django.template.defaultfilters import slugify
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
@@ -42,14 +44,18 @@ from urlobject import URLObject
 
 
 from .fields import URLField
-from .tasks import (ensure_subscribed, store_entries, update_favicon,
-                    update_feed)
-from .utils import (epoch_to_utc, FAVICON_FETCHER, get_job, is_feed,
-                    JobNotFound, remove_utm_tags, resolve_url, USER_AGENT)
+from .tasks import (ensure_subscribed, forget_seen, store_entries,
+                    update_favicon, update_feed)
+from .utils import (content_fingerprint, epoch_to_utc, FAVICON_FETCHER,
+                    FeedTooLarge, get_job, get_jobs, is_feed, JobNotFound,
+                    read_feed, remove_utm_tags, resolve_url, Sanitizer,
+                    schedule_jobs, UnexpectedContent, USER_AGENT,
+                    utc_to_epoch)
 from .. import es
+from ..profiles.models import User
 from ..storage import OverwritingStorage
 from ..tasks import enqueue
-from ..utils import get_redis_connection
+from ..utils import get_redis_connection, incr_counters
 
 logger = structlog.get_logger(__name__)
 
@@ -137,10 +143,55 @@ class Category(models.Model):
         return super().save(*args, **kwargs)
 
 
-class UniqueFeedManager(models.Manager):
+def prefetch_job_details(objs):
+    """
+    Loads the scheduler data of a list of Feed or UniqueFeed objects in a
+    single round trip instead of one per object.
+    """
+    objs = list(objs)
+    jobs = get_jobs(set([obj.url for obj in objs]))
+    for obj in objs:
+        obj._job_details = jobs[obj.url]
+    return objs
+
+
+class JobDataQuerySet(models.QuerySet):
+    """
+    Adds prefetch_job_details(), which works like prefetch_related() but for
+    the scheduler data attached to feeds.
+    """
+    _prefetch_jobs = False
+
+    def prefetch_job_details(self):
+        clone = self._clone()
+        clone._prefetch_jobs = True
+        return clone
+
+    def _clone(self, **kwargs):
+        clone = super()._clone(**kwargs)
+        clone._prefetch_jobs = self._prefetch_jobs
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if (
+            not fetched and
+            self._prefetch_jobs and
+            issubclass(self._iterable_class, ModelIterable)
+        ):
+            prefetch_job_details(self._result_cache)
+
+
+class UniqueFeedManager(models.Manager.from_queryset(JobDataQuerySet)):
     def update_feed(self, url, etag=None, last_modified=None, subscribers=1,
                     backoff_factor=1, previous_error=None, link=None,
-                    title=None, hub=None):
+                    title=None, hub=None, arrivals=None, fingerprint=None,
+                    hwm=None, recent=None, session=None):
+        """
+        Fetches and parses a feed, then reschedules it. ``session`` is an
+        optional ``requests.Session`` for reusing connections to the host.
+        """
         url = URLObject(url)
         try:
             domain = url.netloc.without_auth().without_port()
@@ -174,9 +225,10 @@ class UniqueFeedManager(models.Manager):
         if last_modified or etag:
             headers['A-IM'] = b'feed'
 
+        http = requests if session is None else session
         if settings.TESTS:
             # Make sure requests.get is properly mocked during tests
-            if str(type(requests.get)) != "<class 'unittest.mock.MagicMock'>":
+            if str(type(http.get)) != "<class 'unittest.mock.MagicMock'>":
                 raise ValueError("Not Mocked")
 
         auth = None
@@ -184,11 +236,15 @@ class UniqueFeedManager(models.Manager):
             auth = url.auth
 
         start = datetime.datetime.now()
+        deadline = time.monotonic() + UniqueFeed.download_timeout(
+            backoff_factor)
         error = None
         try:
-            response = requests.get(
+            # Streamed: the body is read with a size cap further down.
+            response = http.get(
                 six.text_type(url.without_auth()), headers=headers, auth=auth,
-                timeout=UniqueFeed.request_timeout(backoff_factor))
+                timeout=UniqueFeed.request_timeout(backoff_factor),
+                stream=True)
         except (requests.RequestException, socket.timeout, socket.error,
                 IncompleteRead, DecodeError) as e:
             logger.info("error fetching", url=url, exc_info=e)
@@ -229,11 +285,13 @@ class UniqueFeedManager(models.Manager):
         update = {'last_update': int(time.time())}
 
         if response.status_code == 410:
+            response.close()
             logger.info("feed gone", url=url)
             self.mute_feed(url, UniqueFeed.GONE)
             return
 
         elif response.status_code in {400, 401, 403, 404, 500, 502, 503, 521}:
+            response.close()
             self.backoff_feed(url, str(response.status_code), backoff_factor)
             return
 
@@ -246,6 +304,7 @@ class UniqueFeedManager(models.Manager):
             cache.set(ratelimit_key,
                       int(retry_at.strftime('%s')),
                       retry_in)
+            response.close()
             schedule_job(url, schedule_in=retry_in)
             return
 
@@ -261,9 +320,13 @@ class UniqueFeedManager(models.Manager):
             backoff_factor = min(backoff_factor, self.safe_backoff(elapsed))
             update['backoff_factor'] = backoff_factor
 
+        arrivals = UniqueFeed.parse_arrivals(arrivals)
         if response.status_code == 304:
+            response.close()
             schedule_job(url,
-                         schedule_in=UniqueFeed.delay(backoff_factor, hub),
+                         schedule_in=UniqueFeed.delay(
+                             backoff_factor, hub, arrivals=arrivals,
+                             subscribers=subscribers),
                          connection=get_redis_connection(), **update)
             return
 
@@ -278,14 +341,48 @@ class UniqueFeedManager(models.Manager):
             update['modified'] = None
 
         try:
-            if not response.content:
-                content = ' '  # chardet won't detect encoding on empty strings
+            content = read_feed(response, settings.FEED_MAX_SIZE, deadline)
+        except FeedTooLarge:
+            logger.info("feed too large", url=url,
+                        max_size=settings.FEED_MAX_SIZE)
+            self.backoff_feed(url, UniqueFeed.TOO_LARGE,
+                              UniqueFeed.MAX_BACKOFF)
+            return
+        except UnexpectedContent:
+            logger.info("unexpected content", url=url, content_type=ctype)
+            self.backoff_feed(url, UniqueFeed.UNEXPECTED_CONTENT,
+                              UniqueFeed.MAX_BACKOFF)
+            return
+        except (requests.RequestException, socket.timeout, socket.error,
+                IncompleteRead) as e:
+            logger.info("error reading feed", url=url, exc_info=e)
+            if isinstance(e, requests.exceptions.ContentDecodingError):
+                error = UniqueFeed.DECODE_ERROR
+            elif isinstance(e, (requests.exceptions.ChunkedEncodingError,
+                                IncompleteRead)):
+                error = UniqueFeed.CONNECTION_ERROR
             else:
-                content = response.content
-        except socket.timeout:
-            logger.info('timed out', url=url)
-            self.backoff_feed(url, UniqueFeed.TIMEOUT, backoff_factor)
+                error = UniqueFeed.TIMEOUT
+            self.backoff_feed(url, error, backoff_factor)
             return
+        finally:
+            response.close()
+        if not content:
+            content = ' '  # chardet won't detect encoding on empty strings
+
+        # Servers ignoring conditional requests: nothing to parse or store
+        # if the body didn't change.
+        update['fingerprint'] = content_fingerprint(content)
+        if fingerprint is not None and str(fingerprint) == update[
+                'fingerprint']:
+            incr_counters(fetch_unchanged=1)
+            schedule_job(url,
+                         schedule_in=UniqueFeed.delay(
+                             backoff_factor, hub, arrivals=arrivals,
+                             subscribers=subscribers),
+                         connection=get_redis_connection(), **update)
+            return
+        incr_counters(fetch_parsed=1)
 
         parsed = feedparser.parse(content)
 
@@ -314,18 +411,40 @@ class UniqueFeedManager(models.Manager):
                 enqueue(ensure_subscribed, args=[url, update['hub']],
                         queue='low')
 
+        # Only entries past the high-water mark are worth storing.
+        new_entries, hwm, recent = self.new_entries(parsed.entries, hwm,
+                                                    recent)
+        mark = {'hwm': hwm, 'recent': recent}
+        entries = list(filter(
+            None,
+            [self.entry_data(entry, parsed) for entry in new_entries]
+        ))
+        if not entries:
+            # Otherwise the mark only moves once store_entries succeeds.
+            update.update(mark)
+        arrivals = UniqueFeed.merge_arrivals(arrivals, [
+            entry['date'] for entry in entries
+            if not entry['date_generated']])
+        update['arrivals'] = UniqueFeed.format_arrivals(arrivals)
+
         schedule_job(url,
                      schedule_in=UniqueFeed.delay(
                          update.get('backoff_factor', backoff_factor),
-                         update['hub']),
+                         update['hub'], arrivals=arrivals,
+                         subscribers=subscribers),
                      connection=get_redis_connection(), **update)
 
-        entries = list(filter(
-            None,
-            [self.entry_data(entry, parsed) for entry in parsed.entries]
-        ))
+        if 'link' in update or 'title' in update:
+            # Subscription lists show the feed's link and title.
+            self.subscriptions_changed(url)
+
         if len(entries):
-            enqueue(store_entries, args=[url, entries], queue='store')
+            # Batches past the mark may hold a single entry: guid reuse is
+            # only visible on the whole feed.
+            enqueue(store_entries, args=[url, entries], kwargs={
+                'mark': mark,
+                'filter_by_title': self.reuses_guid(parsed.entries),
+            }, queue='store')
 
     @classmethod
     def entry_data(cls, entry, parsed):
@@ -372,6 +491,65 @@ class UniqueFeedManager(models.Manager):
             data['subtitle'] = u'<div>{0}</div>'.format(data['subtitle'])
         return data
 
+    @classmethod
+    def reuses_guid(cls, entries):
+        """
+        Whether all the entries of a feed share a guid, in which case they
+        are told apart by title.
+        """
+        guids = set(entry.get('id') or entry.get('link') or entry.get('title')
+                    for entry in entries)
+        return len(guids) == 1 and len(entries) > 1
+
+    @classmethod
+    def entry_key(cls, entry):
+        """Identifies a feedparser entry without resolving its link."""
+        value = u'\n'.join([entry.get('id') or u'', entry.get('link') or u'',
+                            entry.get('title') or u''])
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def new_entries(cls, entries, hwm=None, recent=None):
+        """
+        Returns the entries past a feed's high-water mark, with the new mark
+        and recent entry keys to store in the job.
+
+        Entries are new unless their key is among the recent ones or they
+        are dated well before the mark (HWM_GRACE allows for entries
+        published late or slightly backdated).
+        """
+        recent = set(str(recent).split(',')) if recent else set()
+        dated = []
+        for entry in entries:
+            date, date_generated = cls.entry_date(entry)
+            dated.append((cls.entry_key(entry),
+                          None if date_generated else utc_to_epoch(date),
+                          entry))
+
+        dates = [date for key, date, entry in dated if date is not None]
+        if hwm:
+            dates.append(int(hwm))
+        new_hwm = max(dates) if dates else None
+        new = []
+        window = []
+        for key, date, entry in dated:
+            if (
+                date is None or new_hwm is None or
+                date > new_hwm - UniqueFeed.HWM_GRACE
+            ):
+                window.append((date or float('inf'), key))
+            if key in recent:
+                continue
+            if hwm and date is not None and (
+                date <= int(hwm) - UniqueFeed.HWM_GRACE
+            ):
+                continue
+            new.append(entry)
+        window.sort(reverse=True)
+        new_recent = ','.join(
+            key for date, key in window[:UniqueFeed.HWM_KEYS]) or None
+        return new, new_hwm, new_recent
+
     @classmethod
     def entry_date(cls, entry):
         date_generated = False
@@ -396,9 +574,17 @@ class UniqueFeedManager(models.Manager):
                 entry_date = timezone.now()
         return entry_date, date_generated
 
+    def subscriptions_changed(self, url):
+        """Invalidates the subscription lists of a feed's subscribers."""
+        user_ids = set(Feed.objects.filter(url=url).values_list(
+            'user_id', flat=True))
+        for user_id in user_ids:
+            User(pk=user_id).subscriptions_changed()
+
     def handle_redirection(self, old_url, new_url):
         logger.info("feed moved", old_url=old_url, new_url=new_url)
         Feed.objects.filter(url=old_url).update(url=new_url)
+        self.subscriptions_changed(new_url)
         unique, created = self.get_or_create(url=new_url)
         if created:
             unique.schedule()
@@ -428,6 +614,16 @@ class UniqueFeedManager(models.Manager):
         """
         return int((response_time * 1.2) / 10) + 1
 
+    def bulk_schedule(self, uniques):
+        """
+        Schedules many feeds at once: one round trip to load the existing
+        jobs and one transaction to write them back.
+        """
+        uniques = prefetch_job_details(uniques)
+        schedule_jobs([
+            (unique.url,) + unique.schedule_args() for unique in uniques
+        ])
+
 
 class JobDataMixin(object):
     @property
@@ -436,6 +632,9 @@ class JobDataMixin(object):
             return {}
         if not hasattr(self, '_job_details'):
             self._job_details = get_job(self.url)
+        if self._job_details is None:
+            # Prefetched, missing from the scheduler
+            raise JobNotFound
         return self._job_details
 
     @property
@@ -481,6 +680,8 @@ class UniqueFeed(JobDataMixin, models.Model):
     CONNECTION_ERROR = 'connerror'
     DECODE_ERROR = 'decodeerror'
     NOT_A_FEED = 'notafeed'
+    TOO_LARGE = 'toolarge'
+    UNEXPECTED_CONTENT = 'unexpectedcontent'
     HTTP_400 = '400'
     HTTP_401 = '401'
     HTTP_403 = '403'
@@ -495,6 +696,8 @@ class UniqueFeed(JobDataMixin, models.Model):
         (CONNECTION_ERROR, 'Connection error'),
         (DECODE_ERROR, 'Decoding error'),
         (NOT_A_FEED, 'Not a valid RSS/Atom feed'),
+        (TOO_LARGE, 'Feed too large'),
+        (UNEXPECTED_CONTENT, 'Unexpected content (not XML)'),
         (HTTP_400, 'HTTP 400'),
         (HTTP_401, 'HTTP 401'),
         (HTTP_403, 'HTTP 403'),
@@ -517,7 +720,21 @@ class UniqueFeed(JobDataMixin, models.Model):
     BACKOFF_EXPONENT = 1.5
     TIMEOUT_BASE = 20
     JOB_ATTRS = ['modified', 'etag', 'backoff_factor', 'error', 'link',
-                 'title', 'hub', 'subscribers', 'last_update']
+                 'title', 'hub', 'subscribers', 'last_update', 'arrivals',
+                 'fingerprint', 'hwm', 'recent']
+
+    # Adaptive scheduling: publication dates of the most recent entries are
+    # kept in the job and feeds are polled about twice per expected entry,
+    # within the bounds below.
+    ARRIVALS_HISTORY = 24
+    ARRIVALS_MIN = 3  # To estimate a posting rate
+    ARRIVALS_HOURLY_MIN = 12  # To estimate time-of-day patterns
+    ADAPTIVE_MAX_DELAY = 24 * 3600  # in seconds
+
+    # High-water mark: entries dated before it (minus a grace period) or
+    # among the most recent keys are skipped when fetching.
+    HWM_GRACE = 2 * 24 * 3600  # in seconds
+    HWM_KEYS = 50
 
     def __str__(self):
         return u'%s' % self.url
@@ -534,24 +751,108 @@ class UniqueFeed(JobDataMixin, models.Model):
         return 10 * backoff_factor
 
     @classmethod
-    def delay(cls, backoff_factor, hub=None):
+    def download_timeout(cls, backoff_factor):
+        # Gives up before the RQ job times out.
+        return cls.TIMEOUT_BASE * backoff_factor * 3 / 4
+
+    @classmethod
+    def delay(cls, backoff_factor, hub=None, arrivals=None, subscribers=1,
+              now=None):
         if hub is not None:
             backoff_factor = max(backoff_factor, 3)
-        return datetime.timedelta(
-            seconds=60 * cls.UPDATE_PERIOD *
-            backoff_factor ** cls.BACKOFF_EXPONENT)
+        seconds = (60 * cls.UPDATE_PERIOD *
+                   backoff_factor ** cls.BACKOFF_EXPONENT)
+        if arrivals:
+            seconds = max(seconds, cls.adaptive_delay(arrivals, subscribers,
+                                                      now=now))
+        return datetime.timedelta(seconds=seconds)
+
+    @classmethod
+    def adaptive_delay(cls, arrivals, subscribers=1, now=None):
+        """
+        Returns the polling delay (in seconds) matching the posting rate
+        given by ``arrivals``, the publication timestamps of recent entries.
+        Feeds without enough history get the base update period.
+        """
+        floor = 60 * cls.UPDATE_PERIOD
+        if len(arrivals) < cls.ARRIVALS_MIN:
+            return floor
+        if now is None:
+            now = int(time.time())
+        arrivals = sorted(arrivals)
+        interval = (arrivals[-1] - arrivals[0]) / (len(arrivals) - 1)
+        # Feeds quiet for longer than usual are slowing down.
+        interval = max(interval, now - arrivals[-1])
+        seconds = interval / 2
+        if len(arrivals) >= cls.ARRIVALS_HOURLY_MIN:
+            seconds *= cls.hourly_factor(arrivals, now)
+        seconds = min(max(seconds, floor), cls.ADAPTIVE_MAX_DELAY)
+        # Popular feeds are polled more often.
+        seconds /= 1 + math.log10(max(subscribers, 1))
+        return max(seconds, floor)
+
+    @classmethod
+    def hourly_factor(cls, arrivals, now):
+        """
+        Shortens the delay when entries are usually published in the next
+        few hours of the day, lengthens it when they rarely are.
+        """
+        window = 3
+        hour = time.gmtime(now).tm_hour
+        hours = {(hour + offset) % 24 for offset in range(window)}
+        share = sum(1 for arrival in arrivals
+                    if time.gmtime(arrival).tm_hour in hours) / len(arrivals)
+        expected = window / 24
+        if not share:
+            return 2
+        return min(max(expected / share, 0.5), 2)
+
+    @classmethod
+    def parse_arrivals(cls, value):
+        # Single values are decoded as integers from the job hash.
+        if not value:
+            return []
+        if isinstance(value, int):
+            return [value]
+        return [int(arrival) for arrival in value.split(',')]
+
+    @classmethod
+    def format_arrivals(cls, arrivals):
+        return ','.join(str(arrival) for arrival in arrivals) or None
+
+    @classmethod
+    def merge_arrivals(cls, arrivals, dates):
+        """
+        Adds entry dates to the history, keeping the most recent distinct
+        timestamps.
+        """
+        merged = set(arrivals)
+        merged.update(utc_to_epoch(date) for date in dates)
+        return sorted(merged)[-cls.ARRIVALS_HISTORY:]
 
     @property
     def schedule_in(self):
         return (
-            self.last_update + self.delay(self.job_details['backoff_factor'],
-                                          self.job_details.get('hub'))
+            self.last_update + self.delay(
+                self.job_details['backoff_factor'],
+                self.job_details.get('hub'),
+                arrivals=self.parse_arrivals(
+                    self.job_details.get('arrivals')),
+                subscribers=self.job_details.get('subscribers', 1))
         ) - timezone.now()
 
     def schedule(self, schedule_in=None, **job):
         if hasattr(self, '_job_details'):
             del self._job_details
-        connection = get_redis_connection()
+        schedule_in, kwargs = self.schedule_args(schedule_in, **job)
+        schedule_job(self.url, schedule_in=schedule_in,
+                     connection=get_redis_connection(), **kwargs)
+
+    def schedule_args(self, schedule_in=None, **job):
+        """
+        Returns the delay and job data for scheduling this feed, based on
+        its current (possibly prefetched) job details.
+        """
         kwargs = {
             'subscribers': 1,
             'backoff_factor': 1,
@@ -566,8 +867,7 @@ class UniqueFeed(JobDataMixin, models.Model):
                 schedule_in = self.schedule_in
             except JobNotFound:
                 schedule_in = self.delay(kwargs['backoff_factor'])
-        schedule_job(self.url, schedule_in=schedule_in,
-                     connection=connection, **kwargs)
+        return schedule_in, kwargs
 
 
 class Feed(JobDataMixin, models.Model):
@@ -588,6 +888,7 @@ class Feed(JobDataMixin, models.Model):
     img_safe = models.BooleanField(_('Display images by default'),
                                    default=False)
 
+    objects = JobDataQuerySet.as_manager()
     tracker = FieldTracker()
 
     def __str__(self):
@@ -601,7 +902,10 @@ class Feed(JobDataMixin, models.Model):
 
     def save(self, *args, **kwargs):
         feed_created = self.pk is None
+        url_changed = not feed_created and self.tracker.has_changed('url')
         super().save(*args, **kwargs)
+        if feed_created or url_changed:
+            forget_seen(self.url)
         unique, created = UniqueFeed.objects.get_or_create(url=self.url)
         if feed_created or created:
             try:
@@ -616,6 +920,7 @@ class Feed(JobDataMixin, models.Model):
                 'link': details.get('link'),
                 'title': details.get('title'),
                 'hub': details.get('hub'),
+                'arrivals': details.get('arrivals'),
             }, queue='high', timeout=20)
             if not settings.TESTS:
                 enqueue_favicon(unique.url)
@@ -651,6 +956,17 @@ class EntryManager(models.Manager):
         return self.filter(read=False).count()
 
 
+def absolutize(html, base_url):
+    """Makes the links of an HTML fragment absolute."""
+    xml = lxml.html.fromstring(html)
+    try:
+        xml.make_links_absolute(base_url)
+    except ValueError as e:
+        if e.args[0] != 'Invalid IPv6 URL':
+            raise
+    return lxml.html.tostring(xml).decode('utf-8')
+
+
 class BaseEntry(object):
     ELEMENTS = (
         feedparser._HTMLSanitizer.acceptable_elements |
@@ -664,6 +980,21 @@ class BaseEntry(object):
         feedparser._HTMLSanitizer.svg_attributes
     ) - set(['id', 'class'])
     CSS_PROPERTIES = feedparser._HTMLSanitizer.acceptable_css_properties
+    MEDIA_ELEMENTS = set(['img', 'audio', 'video', 'iframe', 'object',
+                          'embed', 'script', 'source'])
+
+    SANITIZERS = {
+        'full': Sanitizer(ELEMENTS, ATTRIBUTES, CSS_PROPERTIES),
+        'nomedia': Sanitizer(ELEMENTS - MEDIA_ELEMENTS, ATTRIBUTES,
+                             CSS_PROPERTIES),
+        'title': Sanitizer([], bleach.ALLOWED_ATTRIBUTES,
+                           bleach.ALLOWED_STYLES),
+    }
+    SANITIZED_CACHE_TTL = 3600 * 24
+    # Policies rendered at ingest time. Bump SANITIZE_VERSION when they
+    # change and run the sanitize_contents command.
+    STORED_POLICIES = ('full', 'nomedia')
+    SANITIZE_VERSION = 1
 
     @property
     def hex_pk(self):
@@ -680,41 +1011,64 @@ class BaseEntry(object):
     def content(self):
         if not hasattr(self, '_content'):
             if self.subtitle:
-                xml = lxml.html.fromstring(self.subtitle)
-                try:
-                    xml.make_links_absolute(self.feed.url)
-                except ValueError as e:
-                    if e.args[0] != 'Invalid IPv6 URL':
-                        raise
-                self._content = lxml.html.tostring(xml).decode('utf-8')
+                self._content = absolutize(self.subtitle, self.feed.url)
             else:
                 self._content = self.subtitle
         return self._content
 
+    @classmethod
+    def stored_content(cls, html, base_url):
+        """
+        Fields of a content document: the raw body and its sanitized
+        variants, rendered once at ingest time instead of on every view.
+        Variants are left out when the body can't be parsed.
+        """
+        data = {'content': html, 'url': base_url}
+        content = html
+        if content:
+            try:
+                content = absolutize(content, base_url)
+            except (ParserError, ValueError) as e:
+                logger.info("unable to absolutize content", url=base_url,
+                            exc_info=e)
+                return data
+        data['sanitized'] = {policy: cls.SANITIZERS[policy].clean(content)
+                             for policy in cls.STORED_POLICIES}
+        data['sanitized_version'] = cls.SANITIZE_VERSION
+        return data
+
+    def stored_sanitized(self):
+        """Sanitized variants rendered at ingest time, if any."""
+        return None
+
     def sanitized_title(self):
         if self.title:
-            return unescape_entities(bleach.clean(self.title, tags=[],
-                                                  strip=True))
+            return unescape_entities(self.SANITIZERS['title'].clean(
+                self.title))
         return _('(No title)')
 
+    def sanitize(self, policy):
+        """
+        Sanitized content for the given policy. Variants stored at ingest
+        time are used as-is, others are sanitized and cached per entry.
+        """
+        stored = self.stored_sanitized()
+        if stored and policy in stored:
+            return stored[policy]
+        if self.pk is None:
+            return self.SANITIZERS[policy].clean(self.content)
+        cache_key = 'sanitized:{0}:{1}'.format(policy, self.pk)
+        value = cache.get(cache_key)
+        if value is None:
+            value = self.SANITIZERS[policy].clean(self.content)
+            cache.set(cache_key, value, self.SANITIZED_CACHE_TTL)
+        return value
+
     def sanitized_content(self):
-        return bleach.clean(
-            self.content,
-            tags=self.ELEMENTS,
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
-        )
+        return self.sanitize('full')
 
     def sanitized_nomedia_content(self):
-        return bleach.clean(
-            self.content,
-            tags=self.ELEMENTS - set(['img', 'audio', 'video', 'iframe',
-                                      'object', 'embed', 'script', 'source']),
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
-        )
+        return self.sanitize('nomedia')
 
     def get_absolute_url(self):
         return reverse('feeds:item', args=[self.pk])
@@ -853,6 +1207,10 @@ class Entry(BaseEntry, models.Model):
         name = es.user_alias(self.user_id)
         data = es.client.index(name, doc_type='entries', body=self.serialize(),
                                id=self.pk, params={'refresh': True})
+        deltas = {}
+        if not self.read and self.feed_id:
+            deltas[self.feed_id] = 1
+        User(pk=self.user_id).incr_unread_counts(deltas)
         data['_source'] = self.serialize()
         data['_id'] = int(data['_id'])
         return EsEntry(data)
@@ -862,7 +1220,8 @@ class EsEntry(BaseEntry):
     __slots__ = (
         'feed', 'category', 'guid', 'tags', 'read', 'timestamp', 'author',
         'broadcast', 'date', 'link', 'title', 'starred',
-        'read_later_url', 'pk', 'subtitle', '_content', 'user',
+        'read_later_url', 'pk', '_subtitle', '_content', 'user', 'content_id',
+        '_sanitized',
     )
 
     def __repr__(self):
@@ -874,7 +1233,11 @@ class EsEntry(BaseEntry):
             entry['_id'] = int(entry['_id'])
 
         self.pk = entry['_id']
-        self.subtitle = entry['_source'].pop('content', None)
+        # Bodies either come inline or live in the shared content index and
+        # are loaded on first access (or in bulk, see es.join_contents).
+        self._subtitle = entry['_source'].pop('content', None)
+        self.content_id = entry['_source'].pop('content_id', None)
+        self._sanitized = None
         for key, value in entry['_source'].items():
             setattr(self, key, value)
         if hasattr(self, 'timestamp'):
@@ -887,16 +1250,56 @@ class EsEntry(BaseEntry):
     def __str__(self):
         return u'%s' % self.title
 
+    @property
+    def content_pending(self):
+        return self._subtitle is None and self.content_id is not None
+
+    def load_content(self, source):
+        """Sets the body from a content document."""
+        self._subtitle = source.get('content', '')
+        if source.get('sanitized_version') == self.SANITIZE_VERSION:
+            self._sanitized = source.get('sanitized')
+
+    @property
+    def subtitle(self):
+        if self.content_pending:
+            self.load_content(
+                es.contents([self.content_id]).get(self.content_id, {}))
+        return self._subtitle
+
+    @subtitle.setter
+    def subtitle(self, value):
+        self._subtitle = value
+        self._sanitized = None
+
+    def stored_sanitized(self):
+        if self.content_pending:
+            self.subtitle  # loads the whole content document
+        return self._sanitized
+
+    @property
+    def feed_id(self):
+        return getattr(self.feed, 'pk', self.feed)
+
     def update(self, refresh=False, **attrs):
+        delta = 0
+        if 'read' in attrs and getattr(self, 'read', None) is not None:
+            if attrs['read'] != self.read:
+                delta = -1 if attrs['read'] else 1
         for key, value in attrs.items():
             setattr(self, key, value)
         es.client.update(es.user_alias(self.user.pk), doc_type='entries',
                          id=self.pk, body={'doc': attrs},
                          params={'refresh': refresh})
+        self.user.incr_unread_counts({self.feed_id: delta})
 
     def delete(self):
         es.client.delete(es.user_alias(self.user.pk), doc_type='entries',
                          id=self.pk)
+        deltas = {}
+        if getattr(self, 'read', None) is False:
+            deltas[self.feed_id] = -1
+        self.user.incr_unread_counts(deltas)
 
 
 def pubsubhubbub_update(notification, request, links, **kwargs):
@@ -932,6 +1335,19 @@ def pubsubhubbub_update(notification, request, links, **kwargs):
 updated.connect(pubsubhubbub_update)
 
 
+def user_data_changed(sender, instance, **kwargs):
+    """Subscriptions and tags are part of the user's version."""
+    user = User(pk=instance.user_id)
+    user.subscriptions_changed()
+    # Requests running before the commit may have read the previous state.
+    transaction.on_commit(user.subscriptions_changed)
+
+
+for model in [Feed, Category]:
+    models.signals.post_save.connect(user_data_changed, sender=model)
+    models.signals.post_delete.connect(user_data_changed, sender=model)
+
+
 class FaviconManager(models.Manager):
     def update_favicon(self, url, force_update=False):
         if not url:
@@ -1,3 +1,6 @@
+import hashlib
+import time
+import uuid
 from collections import defaultdict
 from datetime import timedelta
 
@@ -6,27 +9,38 @@ import structlog
 from django.conf import settings
 from django.utils import timezone
 from django_push.subscriber.models import Subscription, SubscriptionError
-from rache import schedule_job
+from more_itertools import chunked
+from rache import job_key, schedule_job
 from requests.exceptions import MissingSchema
 from rq.timeouts import JobTimeoutException
 
 from .. import es
 from ..profiles.models import User
-from ..utils import get_redis_connection
+from ..tasks import enqueue
+from ..utils import get_redis_connection, incr_counters
 
 logger = structlog.get_logger(__name__)
 
+# Maximum number of subscribers handled by a single store_entries job
+FANOUT_CHUNK_SIZE = 200
+# Upper bound for the retention of seen entries marks
+SEEN_MAX_DAYS = 365
+# Lifetime of the pending sub-job counter of a fanned out store job
+FANOUT_TTL = 3600 * 24
+
 
 # TODO remove unused request_timeout
 def update_feed(url, etag=None, modified=None, subscribers=1,
                 request_timeout=10, backoff_factor=1, error=None, link=None,
-                title=None, hub=None):
+                title=None, hub=None, arrivals=None, fingerprint=None,
+                hwm=None, recent=None, session=None):
     from .models import UniqueFeed
     try:
         UniqueFeed.objects.update_feed(
             url, etag=etag, last_modified=modified, subscribers=subscribers,
             backoff_factor=backoff_factor, previous_error=error, link=link,
-            title=title, hub=hub)
+            title=title, hub=hub, arrivals=arrivals, fingerprint=fingerprint,
+            hwm=hwm, recent=recent, session=session)
     except JobTimeoutException:
         backoff_factor = min(UniqueFeed.MAX_BACKOFF,
                              backoff_factor + 1)
@@ -91,13 +105,147 @@ def should_skip(date, ttl):
     return date + delta < timezone.now()
 
 
-def store_entries(feed_url, entries):
+def seen_key(feed_url):
+    return 'seen:{0}'.format(feed_url)
+
+
+def seen_member(entry, by_title):
+    value = u't:{0}'.format(entry['title']) if by_title else (
+        u'g:{0}'.format(entry['guid']))
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]
+
+
+def filter_seen(feed_url, entries, by_title):
+    """
+    Drops entries already stored for every subscriber of the feed, without
+    querying elasticsearch.
+    """
+    redis = get_redis_connection()
+    key = seen_key(feed_url)
+    with redis.pipeline() as pipe:
+        for entry in entries:
+            pipe.zscore(key, seen_member(entry, by_title))
+        scores = pipe.execute()
+    return [entry for entry, score in zip(entries, scores) if score is None]
+
+
+def mark_seen(feed_url, entries, by_title, ttl):
+    """
+    Records entries as stored for all the subscribers of the feed. Marks
+    older than the longest subscriber retention are trimmed.
+    """
+    max_age = 3600 * 24 * min(ttl or SEEN_MAX_DAYS, SEEN_MAX_DAYS)
+    now = int(time.time())
+    redis = get_redis_connection()
+    key = seen_key(feed_url)
+    with redis.pipeline() as pipe:
+        for entry in entries:
+            pipe.zadd(key, seen_member(entry, by_title), now)
+        pipe.zremrangebyscore(key, 0, now - max_age)
+        pipe.expire(key, max_age)
+        pipe.execute()
+
+
+def forget_seen(feed_url):
+    """New subscribers need to get every entry stored."""
+    redis = get_redis_connection()
+    with redis.pipeline() as pipe:
+        pipe.delete(seen_key(feed_url))
+        # Unchanged bodies and entries past the high-water mark would be
+        # skipped before reaching store_entries.
+        pipe.hdel(job_key(feed_url), 'fingerprint', 'hwm', 'recent')
+        pipe.execute()
+
+
+def advance_mark(feed_url, hwm, recent):
+    """
+    Moves a feed's high-water mark once the entries past the previous one
+    are stored.
+    """
+    redis = get_redis_connection()
+    key = job_key(feed_url)
+    if not redis.exists(key):
+        # The feed lost its last subscriber meanwhile.
+        return
+    with redis.pipeline() as pipe:
+        for field, value in [('hwm', hwm), ('recent', recent)]:
+            if value is None:
+                pipe.hdel(key, field)
+            else:
+                pipe.hset(key, field, value)
+        pipe.execute()
+
+
+def fan_out(feed_url, entries, feeds, by_title, mark=None):
+    """
+    Splits a store job for a feed with many subscribers into parallel
+    sub-jobs of at most FANOUT_CHUNK_SIZE subscribers each. Subscribers are
+    grouped by user so each sub-job hits a bounded set of aliases.
+
+    Entries are only marked as seen, and the high-water mark only moves,
+    once every sub-job has succeeded.
+    """
+    pks = [feed['pk'] for feed in sorted(feeds, key=lambda f: f['user_id'])]
+    chunks = list(chunked(pks, FANOUT_CHUNK_SIZE))
+    logger.info("fanning out store job", url=feed_url, subscribers=len(pks),
+                chunks=len(chunks))
+    incr_counters(store_fanouts=1, store_fanout_jobs=len(chunks))
+    fanout = {
+        'key': u'fanout:{0}:{1}'.format(feed_url, uuid.uuid4().hex),
+        'ttl': max([feed['user__ttl'] for feed in feeds]),
+        'mark': mark,
+    }
+    get_redis_connection().set(fanout['key'], len(chunks), ex=FANOUT_TTL)
+    for chunk in chunks:
+        # Copies: store_entries alters entries, and eager jobs share them.
+        enqueue(store_entries,
+                args=[feed_url, [dict(entry) for entry in entries]],
+                kwargs={'feed_pks': chunk, 'filter_by_title': by_title,
+                        'fanout': fanout},
+                queue='store')
+
+
+def fan_in(feed_url, entries, by_title, fanout):
+    """Called by each successful sub-job of a fanned out store job."""
+    redis = get_redis_connection()
+    if redis.decr(fanout['key']) > 0:
+        return
+    redis.delete(fanout['key'])
+    mark_seen(feed_url, entries, by_title, fanout['ttl'])
+    if fanout['mark'] is not None:
+        advance_mark(feed_url, **fanout['mark'])
+
+
+def store_entries(feed_url, entries, feed_pks=None, filter_by_title=None,
+                  mark=None, fanout=None):
+    """
+    Stores new entries for the subscribers of a feed. ``mark`` is the feed's
+    high-water mark (hwm and recent job fields) to record once the entries
+    are stored. ``fanout`` is set on sub-jobs of a fanned out store job.
+    """
     from .models import Entry, Feed
 
+    if filter_by_title is None:
+        # All items have the same guid. Query by title instead.
+        guids = set([entry['guid'] for entry in entries])
+        filter_by_title = len(guids) == 1 and len(entries) > 1
+
+    if feed_pks is None:
+        entries = filter_seen(feed_url, entries, filter_by_title)
+        if not entries:
+            if mark is not None:
+                advance_mark(feed_url, **mark)
+            return
+
     feeds = Feed.objects.select_related('user').filter(
-        url=feed_url, user__is_suspended=False).values('pk', 'user_id',
-                                                       'category_id',
-                                                       'user__ttl')
+        url=feed_url, user__is_suspended=False)
+    if feed_pks is not None:
+        feeds = feeds.filter(pk__in=feed_pks)
+    feeds = feeds.values('pk', 'user_id', 'category_id', 'user__ttl')
+
+    if feed_pks is None and len(feeds) > FANOUT_CHUNK_SIZE:
+        fan_out(feed_url, entries, feeds, filter_by_title, mark=mark)
+        return
 
     guids = set([entry['guid'] for entry in entries])
 
@@ -110,9 +258,7 @@ def store_entries(feed_url, entries):
         limit = earliest - timedelta(days=1)
         es_query.append({'range': {'timestamp': {'gt': limit}}})
 
-    filter_by_title = len(guids) == 1 and len(entries) > 1
     if filter_by_title:
-        # All items have the same guid. Query by title instead.
         titles = set([entry['title'] for entry in entries])
         es_query.append({'or': [{'term': {'raw_title': t}} for t in titles]})
     else:
@@ -126,16 +272,7 @@ def store_entries(feed_url, entries):
 
     if indices:
         es.wait_for_yellow()
-        # Make sure guid and raw_title are not analyzed before querying
-        # anything. Otherwise existing entries are never matched and things
-        # keep being inserted.
-        mappings = es.client.indices.get_field_mapping(index=",".join(indices),
-                                                       doc_type='entries',
-                                                       field='guid,raw_title')
-        for mapping in mappings.values():
-            mapping = mapping['mappings']['entries']
-            for f in ['raw_title', 'guid']:
-                assert mapping[f]['mapping'][f]['index'] == 'not_analyzed'
+        es.verify_mapping()
         existing_es = es.client.search(
             index=",".join(indices),
             doc_type='entries',
@@ -181,6 +318,7 @@ def store_entries(feed_url, entries):
                 existing_es_titles[bucket['key']].add(sub['key'])
 
     ops = []
+    content_ops = {}
     refresh_updates = defaultdict(list)
     for feed in feeds:
         seen_guids = set()
@@ -211,10 +349,23 @@ def store_entries(feed_url, entries):
             seen_guids.add(entry['guid'])
 
             data = Entry(**entry).serialize()
+            # Bodies are shared by all subscribers, only store (and
+            # sanitize) them once.
+            content_id = es.content_id(
+                feed_url,
+                data['raw_title'] if filter_by_title else data['guid'])
+            content = data.pop('content')
+            if content_id not in content_ops:
+                content_ops[content_id] = dict(
+                    Entry.stored_content(content, feed_url),
+                    _index=settings.ES_CONTENT_INDEX,
+                    _type='content',
+                    _id=content_id,
+                    timestamp=data['timestamp'],
+                )
+            data['content_id'] = content_id
             data['category'] = feed['category_id']
             data['feed'] = feed['pk']
-            data['_id'] = es.next_id()
-            data['id'] = data['_id']
             data['_type'] = 'entries'
             data['user'] = feed['user_id']
             data['_index'] = settings.ES_INDEX
@@ -222,6 +373,10 @@ def store_entries(feed_url, entries):
             refresh_updates[feed['user_id']].append(entry['date'])
 
     if ops:
+        # One round trip for all the IDs instead of one per entry.
+        for data, pk in zip(ops, es.next_ids(len(ops))):
+            data['_id'] = data['id'] = pk
+        ops.extend(content_ops.values())
         es.bulk(ops, raise_on_error=True)
 
         if settings.TESTS:
@@ -230,9 +385,23 @@ def store_entries(feed_url, entries):
             indices = ",".join(set([doc['_index'] for doc in ops]))
             es.client.indices.refresh(indices)
 
+    if feed_pks is None and feeds:
+        mark_seen(feed_url, entries, filter_by_title,
+                  max([feed['user__ttl'] for feed in feeds]))
+    if mark is not None:
+        advance_mark(feed_url, **mark)
+    if fanout is not None:
+        fan_in(feed_url, entries, filter_by_title, fanout)
+
+    unread = defaultdict(lambda: defaultdict(int))
+    for data in ops:
+        if data.get('_type') == 'entries':
+            unread[data['user']][data['feed']] += 1
+
     redis = get_redis_connection()
     for user_id, dates in refresh_updates.items():
         user = User(pk=user_id)
+        user.incr_unread_counts(unread[user_id])
         new_score = float(max(dates).strftime('%s'))
         current_score = redis.zscore(user.last_update_key, feed_url) or 0
         if new_score > current_score:
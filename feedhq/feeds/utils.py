@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
+import calendar
+import codecs
 import datetime
+import hashlib
+import re
+import threading
+import time
 from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
+import bleach
+import html5lib
 import requests
+from bleach.encoding import force_unicode
+from bleach.sanitizer import BleachSanitizer
 from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
-from rache import job_details, job_key
+from rache import job_details, job_key, REDIS_KEY
 from requests.exceptions import (ConnectionError, ConnectTimeout,
                                  InvalidSchema, InvalidURL, MissingSchema,
-                                 ReadTimeout, TooManyRedirects)
+                                 ReadTimeout, Timeout, TooManyRedirects)
 from requests.packages.urllib3.exceptions import LocationValueError
 
 from .. import __version__
@@ -28,12 +38,109 @@ def is_feed(parsed):
     return hasattr(parsed.feed, 'title')
 
 
+def update_limit():
+    """
+    Number of due jobs processed by one scheduler run (updatefeeds and
+    fetchfeeds run every 5 minutes): twice the share of unique feeds due in
+    that time.
+    """
+    from .models import UniqueFeed
+    ratio = UniqueFeed.UPDATE_PERIOD // 5
+    return max(1, UniqueFeed.objects.filter(muted=False).count() // ratio) * 2
+
+
 def epoch_to_utc(value):
     """Converts epoch (in seconds) values to a timezone-aware datetime."""
     return timezone.make_aware(
         datetime.datetime.fromtimestamp(value), timezone.utc)
 
 
+def utc_to_epoch(value):
+    """Converts a datetime to epoch seconds, without going through
+    strftime()."""
+    return calendar.timegm(value.utctimetuple())
+
+
+# Feed-level elements that change on every request even when entries don't.
+VOLATILE_RE = re.compile(
+    br'<(lastBuildDate|pubDate|updated|dc:date|sy:updateBase)\b[^>]*>'
+    br'[^<]*</\1>|<!--.*?-->', re.DOTALL | re.IGNORECASE)
+FIRST_ENTRY_RE = re.compile(br'<(item|entry)\b', re.IGNORECASE)
+WHITESPACE_RE = re.compile(br'\s+')
+
+
+def content_fingerprint(content):
+    """
+    Hashes a feed body, ignoring whitespace and the timestamps servers put
+    in the feed header. Entries are hashed verbatim.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    match = FIRST_ENTRY_RE.search(content)
+    split = match.start() if match is not None else len(content)
+    head = VOLATILE_RE.sub(b'', content[:split])
+    normalized = WHITESPACE_RE.sub(b'', head + content[split:])
+    return hashlib.sha1(normalized).hexdigest()
+
+
+FEED_CHUNK_SIZE = 64 * 1024
+FEED_CONTENT_TYPES = ('xml', 'rss', 'atom', 'rdf')
+BOMS = (codecs.BOM_UTF8, codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE,
+        codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+
+class FeedTooLarge(Exception):
+    pass
+
+
+class UnexpectedContent(Exception):
+    pass
+
+
+def looks_like_markup(chunk):
+    """Whether the first bytes of a body could be XML (or HTML)."""
+    for bom in BOMS:
+        if chunk.startswith(bom):
+            chunk = chunk[len(bom):]
+            break
+    # UTF-16 / UTF-32 without BOM
+    chunk = chunk[:1024].replace(b'\x00', b'').lstrip()
+    return not chunk or chunk.startswith(b'<')
+
+
+def read_feed(response, max_size, deadline=None):
+    """
+    Reads the body of a streamed response, up to ``max_size`` bytes.
+
+    Raises FeedTooLarge past ``max_size``, UnexpectedContent when neither
+    the content type nor the first bytes look like a feed, and
+    requests' Timeout when the download goes past ``deadline`` (a
+    time.monotonic() value). Read stalls time out with the request.
+    """
+    length = response.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > max_size:
+        raise FeedTooLarge
+    content_type = response.headers.get('Content-Type') or ''
+    sniff = not any(part in content_type.lower()
+                    for part in FEED_CONTENT_TYPES)
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(FEED_CHUNK_SIZE):
+        if not chunk:
+            continue
+        if sniff:
+            if not looks_like_markup(chunk):
+                raise UnexpectedContent
+            sniff = False
+        size += len(chunk)
+        if size > max_size:
+            raise FeedTooLarge
+        chunks.append(chunk)
+        if deadline is not None and time.monotonic() > deadline:
+            raise Timeout("Download took too long")
+    return b''.join(chunks)
+
+
 class JobNotFound(Exception):
     pass
 
@@ -46,6 +153,83 @@ def get_job(name):
     return job_details(name, connection=redis)
 
 
+def _decode_job(name, data, schedule_at):
+    """Same decoding as rache.job_details(), without the round trips."""
+    job = {'id': name}
+    if schedule_at is not None:
+        job['schedule_at'] = int(schedule_at)
+    for key, value in data.items():
+        try:
+            decoded = value.decode('utf-8')
+        except UnicodeDecodeError:
+            decoded = value
+        if decoded.isdigit():
+            decoded = int(decoded)
+        job[key.decode('utf-8')] = decoded
+    return job
+
+
+def get_jobs(names):
+    """
+    Loads the details of many jobs in a single pipelined round trip.
+
+    Returns a dict mapping job names to their details, or to None for jobs
+    missing from the scheduler.
+    """
+    names = list(names)
+    if not names:
+        return {}
+    redis = get_redis_connection()
+    with redis.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.hgetall(job_key(name))
+            pipe.zscore(REDIS_KEY, name)
+        results = pipe.execute()
+    jobs = {}
+    for index, name in enumerate(names):
+        data, schedule_at = results[2 * index], results[2 * index + 1]
+        if not data:
+            jobs[name] = None
+        else:
+            jobs[name] = _decode_job(name, data, schedule_at)
+    return jobs
+
+
+def schedule_jobs(jobs):
+    """
+    Pipelined version of rache.schedule_job(). ``jobs`` is an iterable of
+    ``(job_id, schedule_in, kwargs)`` tuples, written in a single
+    transaction.
+    """
+    now = int(time.time())
+    redis = get_redis_connection()
+    with redis.pipeline() as pipe:
+        for job_id, schedule_in, kwargs in jobs:
+            if 'id' in kwargs:
+                raise RuntimeError("'id' is a reserved key for the job ID")
+            if not isinstance(schedule_in, int):  # assumed to be a timedelta
+                schedule_in = (schedule_in.days * 3600 * 24 +
+                               schedule_in.seconds)
+            pipe.zadd(REDIS_KEY, job_id, now + schedule_in)
+            hmset = {k: v for k, v in kwargs.items() if v is not None}
+            delete = [k for k, v in kwargs.items() if v is None]
+            if hmset:
+                pipe.hmset(job_key(job_id), hmset)
+            if delete:
+                pipe.hdel(job_key(job_id), *delete)
+        pipe.execute()
+
+
+def delete_jobs(job_ids):
+    """Pipelined version of rache.delete_job()."""
+    redis = get_redis_connection()
+    with redis.pipeline() as pipe:
+        for job_id in job_ids:
+            pipe.delete(job_key(job_id))
+            pipe.zrem(REDIS_KEY, job_id)
+        pipe.execute()
+
+
 def remove_utm_tags(guid):
     parts = list(urlsplit(guid))
     qs = parse_qs(parts[3])  # [3] is query component
@@ -74,3 +258,37 @@ def resolve_url(url):
                 resolved = response.url
         cache.set(cache_key, resolved, 3600 * 24 * 5)
     return resolved
+
+
+class Sanitizer(object):
+    """
+    Equivalent to ``bleach.clean()`` with a fixed policy. bleach builds a
+    sanitizer class and an html5lib parser on every call, here they're built
+    once and parsers are reused (one per thread).
+    """
+    def __init__(self, tags, attributes, styles,
+                 protocols=bleach.ALLOWED_PROTOCOLS, strip=True,
+                 strip_comments=True):
+        class PolicySanitizer(BleachSanitizer):
+            allowed_elements = tags
+            allowed_attributes = attributes
+            allowed_css_properties = styles
+            allowed_protocols = protocols
+            strip_disallowed_elements = strip
+            strip_html_comments = strip_comments
+        self.tokenizer = PolicySanitizer
+        self.local = threading.local()
+
+    @property
+    def parser(self):
+        parser = getattr(self.local, 'parser', None)
+        if parser is None:
+            parser = html5lib.HTMLParser(tokenizer=self.tokenizer)
+            self.local.parser = parser
+        return parser
+
+    def clean(self, text):
+        if not text:
+            return ''
+        fragment = self.parser.parseFragment(force_unicode(text))
+        return bleach._render(fragment)
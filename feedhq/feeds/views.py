@@ -651,10 +651,13 @@ def dashboard(request, mode=None):
     category_feeds = defaultdict(list)
     category_counts = defaultdict(int)
 
-    counts = es.counts(request.user, feed_to_cat.keys(), stars=mode == 'stars')
+    if mode == 'stars':
+        counts = es.counts(request.user, feed_to_cat.keys(), stars=True)
+    else:
+        counts = request.user.unread_counts()
     _all = 0
     for feed in feeds:
-        feed.unread_count = counts[str(feed.pk)][str(feed.pk)]['doc_count']
+        feed.unread_count = counts.get(feed.pk, 0)
         _all += feed.unread_count
         if feed.category_id is None:
             continue
@@ -667,7 +670,7 @@ def dashboard(request, mode=None):
 
     uncategorized = [feed for feed in feeds if feed.category_id is None]
     for feed in uncategorized:
-        feed.unread_count = counts[str(feed.pk)][str(feed.pk)]['doc_count']
+        feed.unread_count = counts.get(feed.pk, 0)
 
     if mode == 'unread':
         categories = [c for c in categories if c['unread_count']]
@@ -791,7 +794,7 @@ class ManageFeeds(generic.TemplateView):
                 select muted_reason from feeds_uniquefeed
                 where feeds_uniquefeed.url = feeds_feed.url
             """,
-        })
+        }).prefetch_job_details()
 
         ctx['feeds'] = feeds
         return ctx
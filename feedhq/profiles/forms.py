@@ -212,8 +212,8 @@ class DeleteAccountForm(forms.Form):
     def save(self):
         user_id = self.user.pk
         self.user.delete()
-        es.client.delete_by_query(
-            index=es.user_alias(user_id),
-            doc_type='entries',
-            body={'query': {'filtered': {'filter': {'match_all': {}}}}},
+        es.delete_entries(
+            es.user_alias(user_id),
+            {'filtered': {'filter': {'match_all': {}}}},
         )
+        User(pk=user_id).reset_unread_counts()
@@ -1,4 +1,5 @@
 import json
+import time
 
 from datetime import timedelta
 
@@ -6,6 +7,7 @@ import pytz
 from django.conf import settings
 from django.contrib.auth.models import (AbstractBaseUser, PermissionsMixin,
                                         UserManager)
+from django.core.cache import cache
 from django.db import models
 from django.db.models import Max
 from django.utils import timezone
@@ -24,6 +26,34 @@ ENTRIES_PER_PAGE = (
     (100, 100),
 )
 
+# Unread counters are rebuilt from elasticsearch after this many seconds, to
+# reconcile any drift.
+UNREAD_COUNTS_TTL = 3600
+# Hash field marking the counters as built, as users without unread entries
+# would otherwise have no key at all.
+UNREAD_COUNTS_BUILT = '_built'
+# Only update counters that are already built. Incrementing a missing hash
+# would create partial counts.
+INCR_UNREAD_COUNTS = """
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 1, #ARGV, 2 do
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+
+# Per-user version, bumped whenever entries, subscriptions or tags change.
+# Values are millisecond timestamps forced to grow by at least one so that
+# they never go back, even when an expired key gets re-created.
+VERSION_TTL = 3600 * 24 * 30
+BUMP_VERSION = """
+local current = tonumber(redis.call('get', KEYS[1]) or '0')
+local value = math.max(current + 1, tonumber(ARGV[1]))
+redis.call('set', KEYS[1], value, 'ex', ARGV[2])
+return value
+"""
+
 
 class User(PermissionsMixin, AbstractBaseUser):
     USERNAME_FIELD = 'username'
@@ -141,16 +171,121 @@ class User(PermissionsMixin, AbstractBaseUser):
     def wallabag_url(self):
         return json.loads(self.read_later_credentials)['wallabag_url']
 
+    @property
+    def unread_counts_key(self):
+        return 'user:{0}:unread'.format(self.pk)
+
     @property
     def unread_count(self):
         if hasattr(self, '_unread_count'):
             return self._unread_count
-        return es.client.count(es.user_alias(self.pk),
-                               doc_type='entries',
-                               body={'query': {
-                                   'term': {
-                                       'read': False,
-                                   }}})['count']
+        return sum(self.unread_counts().values())
+
+    def unread_counts(self):
+        """
+        Returns the number of unread entries per feed ID. Feeds without
+        unread entries are omitted.
+        """
+        redis = get_redis_connection()
+        values = redis.hgetall(self.unread_counts_key)
+        if not values:
+            return self.rebuild_unread_counts()
+        counts = {}
+        for pk, count in values.items():
+            pk, count = pk.decode('utf-8'), int(count)
+            if pk == UNREAD_COUNTS_BUILT or count <= 0:
+                continue
+            counts[int(pk)] = count
+        return counts
+
+    def rebuild_unread_counts(self):
+        results = es.client.search(
+            index=es.user_alias(self.pk),
+            doc_type='entries',
+            body={
+                'query': {'filtered': {'filter': {'term': {'read': False}}}},
+                'aggs': {
+                    'feeds': {'terms': {'field': 'feed', 'size': 0}},
+                },
+            },
+            params={'size': 0},
+        )
+        buckets = results.get('aggregations', {}).get(
+            'feeds', {}).get('buckets', [])
+        counts = {bucket['key']: bucket['doc_count'] for bucket in buckets}
+        values = dict(counts)
+        values[UNREAD_COUNTS_BUILT] = 1
+        redis = get_redis_connection()
+        with redis.pipeline() as pipe:
+            pipe.delete(self.unread_counts_key)
+            pipe.hmset(self.unread_counts_key, values)
+            pipe.expire(self.unread_counts_key, UNREAD_COUNTS_TTL)
+            pipe.execute()
+        return counts
+
+    def incr_unread_counts(self, deltas):
+        """
+        Applies {feed_id: delta} changes to the unread counters, if they are
+        built. Called whenever entries change, so it also bumps the user's
+        version.
+        """
+        args = []
+        for pk, delta in deltas.items():
+            if delta:
+                args.extend([pk, delta])
+        if args:
+            redis = get_redis_connection()
+            redis.register_script(INCR_UNREAD_COUNTS)(
+                keys=[self.unread_counts_key], args=args)
+        self.bump_version()
+
+    def reset_unread_counts(self, *feed_pks):
+        """
+        Drops the counters of some feeds (or all counters) when their entries
+        are deleted.
+        """
+        redis = get_redis_connection()
+        if feed_pks:
+            redis.hdel(self.unread_counts_key, *feed_pks)
+        else:
+            redis.delete(self.unread_counts_key)
+        self.bump_version()
+
+    @property
+    def version_key(self):
+        return 'user:{0}:version'.format(self.pk)
+
+    def version(self):
+        """
+        Changes every time the user's data changes. Used to answer
+        conditional requests without recomputing anything.
+        """
+        value = get_redis_connection().get(self.version_key)
+        if value is None:
+            return self.bump_version()
+        return int(value)
+
+    @property
+    def subscriptions_cache_key(self):
+        return 'user:{0}:reader:subscriptions'.format(self.pk)
+
+    @property
+    def tags_cache_key(self):
+        return 'user:{0}:reader:tags'.format(self.pk)
+
+    def subscriptions_changed(self):
+        """
+        Feeds or categories changed: drops the cached subscription and tag
+        lists and bumps the version.
+        """
+        cache.delete_many([self.subscriptions_cache_key, self.tags_cache_key])
+        self.bump_version()
+
+    def bump_version(self):
+        redis = get_redis_connection()
+        return int(redis.register_script(BUMP_VERSION)(
+            keys=[self.version_key],
+            args=[int(time.time() * 1000), VERSION_TTL]))
 
     def last_updates(self):
         redis = get_redis_connection()
@@ -191,30 +326,32 @@ class User(PermissionsMixin, AbstractBaseUser):
         return ret
 
     def delete_feed_entries(self, *pks):
-        return es.client.delete_by_query(
-            index=es.user_alias(self.pk),
-            doc_type='entries',
-            body={'query': {'filtered': {'filter': {'or': [
+        result = es.delete_entries(
+            es.user_alias(self.pk),
+            {'filtered': {'filter': {'or': [
                 {'term': {'feed': pk}} for pk in pks
-            ]}}}},
+            ]}}},
         )
+        self.reset_unread_counts(*pks)
+        return result
 
     def delete_category_entries(self, pk):
-        return es.client.delete_by_query(
-            index=es.user_alias(self.pk),
-            doc_type='entries',
-            body={'query': {'term': {'category': pk}}},
+        result = es.delete_entries(
+            es.user_alias(self.pk),
+            {'term': {'category': pk}},
         )
+        self.reset_unread_counts()
+        return result
 
     def delete_old(self):
         limit = timezone.now() - timedelta(days=self.ttl)
-        es.client.delete_by_query(
-            index=es.user_alias(self.pk),
-            doc_type='entries',
-            body={'query': {'filtered': {
+        es.delete_entries(
+            es.user_alias(self.pk),
+            {'filtered': {
                 'filter': {'and': [
                     {'range': {'timestamp': {'lte': limit}}},
                     {'term': {'starred': False}},
                 ]},
-            }}},
+            }},
         )
+        self.reset_unread_counts()
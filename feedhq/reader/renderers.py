@@ -1,9 +1,11 @@
 import datetime
+import types
 from io import StringIO
 
 import six
+import ujson
 from django.utils.xmlutils import SimplerXMLGenerator
-from rest_framework.renderers import BaseRenderer
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework_xml.renderers import XMLRenderer
 
 
@@ -22,8 +24,38 @@ class PlainRenderer(BaseRenderer):
         return data
 
 
+class ReaderJSONRenderer(JSONRenderer):
+    """
+    Renders plain reader payloads with ujson. The output matches the
+    default compact, unicode JSONRenderer.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if data is None or indent:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        try:
+            ret = ujson.dumps(data, ensure_ascii=False,
+                              escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+        return bytes(ret.encode('utf-8'))
+
+
 class BaseXMLRenderer(XMLRenderer):
+    """
+    Subclasses implement ``_iter_xml()``, a generator that writes to the XML
+    generator and yields whenever a chunk of the document is complete. The
+    document can then be rendered at once or streamed chunk by chunk.
+    """
     strip_declaration = True
+    declaration = '<?xml version="1.0" encoding="utf-8"?>'
+
+    def _to_xml(self, xml, data):
+        for _ in self._iter_xml(xml, data):
+            pass
 
     def render(self, data, accepted_media_type=None, renderer_context=None):
         if data is None:
@@ -39,14 +71,45 @@ class BaseXMLRenderer(XMLRenderer):
         response = stream.getvalue()
 
         if self.strip_declaration:
-            declaration = '<?xml version="1.0" encoding="utf-8"?>'
-            if response.startswith(declaration):
-                response = response[len(declaration):]
+            if response.startswith(self.declaration):
+                response = response[len(self.declaration):]
         return response.strip()
 
+    def stream(self, data, accepted_media_type=None, renderer_context=None):
+        """
+        Same output as ``render()``, yielded as encoded chunks so that only
+        one chunk is held in memory at a time.
+        """
+        if data is None:
+            return
+
+        stream = StringIO()
+        xml = SimplerXMLGenerator(stream, "utf-8")
+
+        def flush():
+            value = stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+            return value
+
+        xml.startDocument()
+        declaration = flush()
+        if not self.strip_declaration:
+            yield declaration.encode('utf-8')
+
+        for _ in self._iter_xml(xml, data):
+            chunk = flush()
+            if chunk:
+                yield chunk.encode('utf-8')
+
+        xml.endDocument()
+        chunk = flush().rstrip()
+        if chunk:
+            yield chunk.encode('utf-8')
+
 
 class GoogleReaderXMLRenderer(BaseXMLRenderer):
-    def _to_xml(self, xml, data):
+    def _iter_xml(self, xml, data):
         """
         Renders *data* into serialized XML, google-reader style.
         """
@@ -55,10 +118,11 @@ class GoogleReaderXMLRenderer(BaseXMLRenderer):
             for key, value in data.items():
                 if isinstance(value, six.string_types) and value.isdigit():
                     value = int(value)
-                if isinstance(value, (list, tuple)):
+                if isinstance(value, (list, tuple, types.GeneratorType)):
                     xml.startElement("list", {'name': key})
                     for item in value:
-                        self._to_xml(xml, item)
+                        yield from self._iter_xml(xml, item)
+                        yield
                     xml.endElement("list")
                 elif isinstance(value, int):
                     xml.startElement("number", {'name': key})
@@ -70,7 +134,7 @@ class GoogleReaderXMLRenderer(BaseXMLRenderer):
                     xml.endElement("string")
                 elif isinstance(value, dict):
                     xml.startElement("object", {'name': key})
-                    self._to_xml(xml, value)
+                    yield from self._iter_xml(xml, value)
                     xml.endElement("object")
             xml.endElement("object")
         elif data == {}:
@@ -88,7 +152,7 @@ class AtomRenderer(BaseXMLRenderer):
     format = 'atom'
     strip_declaration = False
 
-    def _to_xml(self, xml, data):
+    def _iter_xml(self, xml, data):
         if list(data.keys()) == ['detail']:
             xml.startElement('error', {})
             xml.characters(data['detail'])
@@ -195,6 +259,7 @@ class AtomRenderer(BaseXMLRenderer):
             xml.endElement('source')
 
             xml.endElement('entry')
+            yield
 
         xml.endElement('feed')
 
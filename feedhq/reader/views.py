@@ -1,7 +1,10 @@
+import base64
 import json
 import re
 import struct
+import time
 
+from collections import defaultdict
 from datetime import timedelta
 
 import opml
@@ -10,10 +13,12 @@ import structlog
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.models import Q
-from django.http import Http404
+from django.db.models import Prefetch, Q
+from django.http import (Http404, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.shortcuts import render
 from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe
 from lxml.etree import XMLSyntaxError
 from rest_framework import exceptions
 from rest_framework.authentication import SessionAuthentication
@@ -25,14 +30,16 @@ from rest_framework_xml.parsers import XMLParser
 from six.moves.urllib import parse as urlparse
 
 from .authentication import GoogleLoginAuthentication
-from .exceptions import BadToken, PermissionDenied
+from .exceptions import BadToken, NotModified, PermissionDenied
 from .models import check_post_token, generate_auth_token, generate_post_token
 from .renderers import (AtomHifiRenderer, AtomRenderer,
-                        GoogleReaderXMLRenderer, PlainRenderer)
+                        GoogleReaderXMLRenderer, PlainRenderer,
+                        ReaderJSONRenderer)
 from .. import es
 from ..feeds.forms import FeedForm, user_lock
-from ..feeds.models import Category, UniqueFeed
-from ..feeds.utils import epoch_to_utc
+from ..feeds.models import (Category, Feed, prefetch_job_details,
+                            UniqueFeed)
+from ..feeds.utils import epoch_to_utc, utc_to_epoch
 from ..feeds.views import save_outline
 from ..profiles.models import User
 from ..utils import is_email
@@ -42,6 +49,10 @@ logger = structlog.get_logger(__name__)
 
 MISSING_SLASH_RE = re.compile("^(https?:\/)[^\/]")
 
+# Cached subscription and tag lists are dropped whenever feeds or
+# categories change. Links of unique feeds can still change in between.
+SUBSCRIPTIONS_CACHE_TIMEOUT = 3600
+
 
 def list_attr(data, key):
     """
@@ -195,6 +206,11 @@ class ReaderView(APIView):
     renderer_classes = [JSONRenderer, GoogleReaderXMLRenderer]
     content_negotiation_class = ForceNegotiation
     require_post_token = True
+    # Send the response as it's rendered when the renderer supports it.
+    streaming = False
+    # Answer GET requests with 304 Not Modified when the user's data didn't
+    # change since the client's copy.
+    conditional = False
 
     def initial(self, request, *args, **kwargs):
         super().initial(request, *args, **kwargs)
@@ -207,10 +223,37 @@ class ReaderView(APIView):
             user_id = check_post_token(token)
             if not user_id == request.user.pk:
                 raise BadToken
+        if request.method == 'GET' and self.conditional:
+            self.check_modified(request)
+
+    def check_modified(self, request):
+        version = request.user.version()
+        etag = '"{0}-{1}"'.format(version, request.accepted_renderer.format)
+        # Last-Modified can't be in the future. The ETag carries the exact
+        # version, it takes precedence when clients send both.
+        last_modified = min(version // 1000, int(time.time()))
+        self.headers['ETag'] = etag
+        self.headers['Last-Modified'] = http_date(last_modified)
+        self.headers['Cache-Control'] = 'private, no-cache'
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = [value.strip() for value in if_none_match.split(',')]
+            if etag in etags or 'W/' + etag in etags or '*' in etags:
+                raise NotModified
+            return
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since is not None and (
+            last_modified <= if_modified_since
+        ):
+            raise NotModified
 
     def handle_exception(self, exc):
         if isinstance(exc, BadToken):
             self.headers['X-Reader-Google-Bad-Token'] = "true"
+        if isinstance(exc, NotModified):
+            return HttpResponseNotModified()
         return super().handle_exception(exc)
 
     def label(self, value):
@@ -224,6 +267,42 @@ class ReaderView(APIView):
             self._negotiator = self.content_negotiation_class(force_format)
         return self._negotiator
 
+    def streams(self):
+        return self.streaming and hasattr(
+            getattr(self.request, 'accepted_renderer', None), 'stream')
+
+    def stream_items(self, serialize, entries):
+        """
+        Keeps serialized items lazy when the response is streamed so that
+        only one of them, and one chunk of bodies, is held in memory at a
+        time. ``entries`` is consumed.
+        """
+        items = (serialize(entry) for entry in es.iter_contents(entries))
+        if self.streams():
+            return items
+        return list(items)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args,
+                                             **kwargs)
+        if (
+            not self.streams() or
+            not isinstance(response, Response) or
+            response.exception
+        ):
+            return response
+        renderer = response.accepted_renderer
+        content_type = '{0}; charset={1}'.format(renderer.media_type,
+                                                 renderer.charset)
+        streaming = StreamingHttpResponse(
+            renderer.stream(response.data, response.accepted_media_type,
+                            response.renderer_context),
+            status=response.status_code, content_type=content_type)
+        for name, value in response.items():
+            if name.lower() != 'content-type':
+                streaming[name] = value
+        return streaming
+
 
 class TokenView(ReaderView):
     http_method_names = ['get', 'post']
@@ -283,100 +362,68 @@ preference_list = PreferenceList.as_view()
 
 class UnreadCount(ReaderView):
     http_method_names = ['get']
+    conditional = True
 
     def get(self, request, *args, **kwargs):
         unread_counts = []
         last_updates = request.user.last_updates()
-        results = es.client.search(
-            index=es.user_alias(request.user.pk),
-            doc_type='entries',
-            body={
-                'query': {
-                    'filtered': {
-                        'filter': {'term': {'read': False}},
-                    },
-                },
-                'aggs': {
-                    'all': {
-                        'global': {},
-                        'aggs': {
-                            'unread': {
-                                'filter': {'term': {'read': False}},
-                                'aggs': {
-                                    'feeds': {
-                                        'terms': {'field': 'feed',
-                                                  'size': 0},
-                                    },
-                                },
-                            },
-                        },
-                    },
-                },
-            },
-            params={'size': 0},
-        )
-        if 'aggregations' in results:
-            feeds = {}
-            for bucket in results['aggregations']['all']['unread'][
-                    'feeds']['buckets']:
-                feeds[bucket['key']] = {
-                    'count': bucket['doc_count'],
-                }
-            if feeds:
-                _feeds = request.user.feeds.filter(
-                    pk__in=feeds.keys()
-                ).select_related('category').values_list(
-                    'pk', 'url', 'category_id', 'category__name'
-                )
-
-                categories = {}
-                total = 0
-                latest = 0
-                for pk, url, category, name in _feeds:
-                    data = feeds[pk]
-                    ts = last_updates.get(url, 0)
-                    if ts:
-                        data['newestItemTimestampUsec'] = (
-                            '{0}000000'.format(ts))
-                    data['id'] = u'feed/{0}'.format(url)
-                    unread_counts.append(data)
-                    total += data['count']
-                    latest = max(latest, ts)
-
-                    if category is None:
-                        continue
-
-                    if category not in categories:
-                        categories[category] = {
-                            'name': name,
-                            'count': 0,
-                            'ts': 0
-                        }
-                    categories[category]['count'] += data['count']
-                    categories[category]['ts'] = max(
-                        categories[category]['ts'], ts)
-
-                for data in categories.values():
-                    info = {
-                        "id": label_key(request, data['name']),
-                        "count": data['count'],
-                        "newestItemTimestampUsec": '{0}000000'.format(
-                            int(data['ts']),
-                        ),
+        feeds = {pk: {'count': count}
+                 for pk, count in request.user.unread_counts().items()}
+        if feeds:
+            _feeds = request.user.feeds.filter(
+                pk__in=feeds.keys()
+            ).select_related('category').values_list(
+                'pk', 'url', 'category_id', 'category__name'
+            )
+
+            categories = {}
+            total = 0
+            latest = 0
+            for pk, url, category, name in _feeds:
+                data = feeds[pk]
+                ts = last_updates.get(url, 0)
+                if ts:
+                    data['newestItemTimestampUsec'] = (
+                        '{0}000000'.format(ts))
+                data['id'] = u'feed/{0}'.format(url)
+                unread_counts.append(data)
+                total += data['count']
+                latest = max(latest, ts)
+
+                if category is None:
+                    continue
+
+                if category not in categories:
+                    categories[category] = {
+                        'name': name,
+                        'count': 0,
+                        'ts': 0
                     }
-                    unread_counts.append(info)
-
-                if total:
-                    unread_counts.append({
-                        "id": (
-                            "user/{0}/state/com.google/"
-                            "reading-list").format(
-                            request.user.pk),
-                        "count": total,
-                        "newestItemTimestampUsec": '{0}000000'.format(
-                            int(latest)
-                        ),
-                    })
+                categories[category]['count'] += data['count']
+                categories[category]['ts'] = max(
+                    categories[category]['ts'], ts)
+
+            for data in categories.values():
+                info = {
+                    "id": label_key(request, data['name']),
+                    "count": data['count'],
+                    "newestItemTimestampUsec": '{0}000000'.format(
+                        int(data['ts']),
+                    ),
+                }
+                unread_counts.append(info)
+
+            if total:
+                unread_counts.append({
+                    "id": (
+                        "user/{0}/state/com.google/"
+                        "reading-list").format(
+                        request.user.pk),
+                    "count": total,
+                    "newestItemTimestampUsec": '{0}000000'.format(
+                        int(latest)
+                    ),
+                })
         return Response({
             "max": 1000,
             "unreadcounts": unread_counts,
@@ -410,23 +457,10 @@ class DisableTag(ReaderView):
         cat_pk = category.pk
         category.delete()
 
-        entries = es.manager.user(request.user).filter(
+        es.manager.user(request.user).filter(
             category=cat_pk,
-        ).aggregate('id').fetch(per_page=0)
-        ids = [bucket['key'] for bucket in entries[
-            'aggregations']['entries']['query']['id']['buckets']]
-
-        if ids:
-            index = es.user_alias(request.user.pk)
-            ops = [{
-                '_op_type': 'update',
-                '_index': index,
-                '_type': 'entries',
-                '_id': pk,
-                'doc': {'category': None},
-            } for pk in ids]
-            with es.ignore_bulk_error(404):
-                es.bulk(ops, raise_on_error=True, params={'refresh': True})
+        ).update({'category': None})
+        request.user.subscriptions_changed()
         return Response("OK")
 
 
@@ -461,6 +495,7 @@ class RenameTag(ReaderView):
 
         category.name = new_name
         category.save()
+        request.user.subscriptions_changed()
 
         return Response("OK")
 
@@ -470,8 +505,17 @@ rename_tag = RenameTag.as_view()
 
 class TagList(ReaderView):
     http_method_names = ['get']
+    conditional = True
 
     def get(self, request, *args, **kwargs):
+        tags = cache.get(request.user.tags_cache_key)
+        if tags is None:
+            tags = self.tags(request)
+            cache.set(request.user.tags_cache_key, tags,
+                      SUBSCRIPTIONS_CACHE_TIMEOUT)
+        return Response({'tags': tags})
+
+    def tags(self, request):
         tags = [{
             "id": "user/{0}/state/com.google/starred".format(request.user.pk),
             "sortid": "A0000001",
@@ -487,7 +531,7 @@ class TagList(ReaderView):
                 "sortid": "A{0}".format(str(index).zfill(7)),
             })
             index += 1
-        return Response({'tags': tags})
+        return tags
 
 
 tag_list = TagList.as_view()
@@ -495,11 +539,28 @@ tag_list = TagList.as_view()
 
 class SubscriptionList(ReaderView):
     http_method_names = ['get']
+    conditional = True
 
     def get(self, request, *args, **kwargs):
+        subscriptions = cache.get(request.user.subscriptions_cache_key)
+        if subscriptions is None:
+            subscriptions = self.subscriptions(request)
+            cache.set(request.user.subscriptions_cache_key, subscriptions,
+                      SUBSCRIPTIONS_CACHE_TIMEOUT)
+        # Depends on the current time, not part of the cached payload.
+        first_item = (timezone.now() - timedelta(
+            days=request.user.ttl or 365)).strftime("%s000")
+        for subscription in subscriptions:
+            subscription['firstitemmsec'] = first_item
+        return Response({
+            "subscriptions": subscriptions
+        })
+
+    def subscriptions(self, request):
         feeds = request.user.feeds.select_related('category',).order_by(
             'category__name', 'name')
-        uniques = UniqueFeed.objects.filter(url__in=[f.url for f in feeds])
+        uniques = UniqueFeed.objects.filter(
+            url__in=[f.url for f in feeds]).prefetch_job_details()
         unique_map = {}
         for unique in uniques:
             if unique.link:
@@ -513,8 +574,6 @@ class SubscriptionList(ReaderView):
                 "categories": [],
                 "sortid": "B{0}".format(str(index).zfill(7)),
                 "htmlUrl": unique_map.get(feed.url, feed.url),
-                "firstitemmsec": (timezone.now() - timedelta(
-                    days=request.user.ttl or 365)).strftime("%s000"),
             }
             if feed.category is not None:
                 subscription['categories'].append({
@@ -522,9 +581,7 @@ class SubscriptionList(ReaderView):
                     "label": feed.category.name,
                 })
             subscriptions.append(subscription)
-        return Response({
-            "subscriptions": subscriptions
-        })
+        return subscriptions
 
 
 subscription_list = SubscriptionList.as_view()
@@ -591,6 +648,8 @@ class EditSubscription(ReaderView):
         else:
             logger.info("unrecognized action", action=action, request=request)
             raise exceptions.ParseError("Unrecognized action: %s" % action)
+        # Edits are queryset updates, which don't send signals.
+        request.user.subscriptions_changed()
         return Response("OK")
 
 
@@ -829,21 +888,47 @@ def get_stream_q(streams, user, exclude=None, include=None, limit=None,
     return q
 
 
+def encode_continuation(sort_values):
+    """
+    Continuations are opaque to clients. They carry the sort values (timestamp
+    and ID) of the last returned entry.
+    """
+    value = ':'.join([str(v) for v in sort_values]).encode('utf-8')
+    return base64.urlsafe_b64encode(value).decode('ascii').rstrip('=')
+
+
+def decode_continuation(c):
+    padded = c + '=' * (-len(c) % 4)
+    try:
+        value = base64.urlsafe_b64decode(padded.encode('ascii'))
+        timestamp, pk = value.decode('utf-8').split(':')
+        return [int(timestamp), int(pk)]
+    except (ValueError, TypeError):
+        raise exceptions.ParseError("Invalid 'c' continuation string")
+
+
 def bounds(n=None, c=None):
-    # ?n=20 (default), ?c=<continuation> for offset
+    """
+    ?n=20 (default), ?c=<continuation> to resume.
+
+    Returns (per_page, page, after). Legacy 'pageN' continuations give a
+    page number, others the sort values to resume after.
+    """
     if n is None:
         n = 20
-    if c is None:
-        c = 'page1'
     try:
         per_page = int(n)
     except ValueError:
         raise exceptions.ParseError("'n' must be an integer")
-    try:
-        page = int(c[4:])
-    except ValueError:
-        raise exceptions.ParseError("Invalid 'c' continuation string")
-    return per_page, page
+    if c is None:
+        return per_page, 1, None
+    if c.startswith('page'):
+        try:
+            page = int(c[4:])
+        except ValueError:
+            raise exceptions.ParseError("Invalid 'c' continuation string")
+        return per_page, page, None
+    return per_page, 1, decode_continuation(c)
 
 
 def continuation_(count, per_page, page):
@@ -853,8 +938,14 @@ def continuation_(count, per_page, page):
     return continuation
 
 
+def stream_continuation(results):
+    """Continuation for results fetched with has_more=True."""
+    if results['has_more'] and results['last_sort']:
+        return encode_continuation(results['last_sort'])
+
+
 def pagination(count, n=None, c=None):
-    per_page, page = bounds(n, c)
+    per_page, page, _after = bounds(n, c)
     continuation = continuation_(count, per_page, page)
     start = max(0, (page - 1) * per_page)
     end = page * per_page
@@ -908,6 +999,72 @@ def serialize_entry(request, entry, uniques):
     return item
 
 
+class ItemSerializer(object):
+    """
+    Same output as serialize_entry(), for serializing many entries of a
+    single request: per-user stream IDs are built once and timestamps are
+    computed with integer math instead of strftime().
+    """
+    def __init__(self, request, uniques):
+        prefix = "user/{0}/state/com.google/".format(request.user.pk)
+        self.reading_list = prefix + "reading-list"
+        self.read = prefix + "read"
+        self.starred = prefix + "starred"
+        self.broadcast = prefix + "broadcast"
+        self.request = request
+        self.uniques = uniques
+        self.labels = {}
+        self.streams = {}
+
+    def label(self, name):
+        if name not in self.labels:
+            self.labels[name] = label_key(self.request, name)
+        return self.labels[name]
+
+    def stream(self, url):
+        if url not in self.streams:
+            self.streams[url] = u"feed/{0}".format(url)
+        return self.streams[url]
+
+    def __call__(self, entry):
+        epoch = utc_to_epoch(entry.date)
+        feed = entry.feed
+        categories = [self.reading_list]
+        item = {
+            "crawlTimeMsec": "{0}000".format(epoch),
+            "timestampUsec": "{0}000000".format(epoch),
+            "id": "tag:google.com,2005:reader/item/{0}".format(entry.hex_pk),
+            "categories": categories,
+            "title": entry.title,
+            "published": epoch,
+            "updated": epoch,
+            "alternate": [{
+                "href": entry.link,
+                "type": "text/html",
+            }],
+            "content": {
+                "direction": "ltr",
+                "content": entry.subtitle,
+            },
+            "origin": {
+                "streamId": self.stream(feed.url),
+                "title": feed.name,
+                "htmlUrl": self.uniques.get(feed.url, feed.url),
+            },
+        }
+        if feed.category is not None:
+            categories.append(self.label(feed.category.name))
+        if entry.read:
+            categories.append(self.read)
+        if entry.starred:
+            categories.append(self.starred)
+        if entry.broadcast:
+            categories.append(self.broadcast)
+        if entry.author:
+            item['author'] = entry.author
+        return item
+
+
 def get_unique_map(user, force=False):
     cache_key = 'reader:unique_map:{0}'.format(user.pk)
     value = cache.get(cache_key)
@@ -920,7 +1077,7 @@ def get_unique_map(user, force=False):
             "on f.user_id = s.id "
             "where f.url = u.url and f.user_id = %s)", [user.pk])
         value = {}
-        for u in unique:
+        for u in prefetch_job_details(unique):
             value[u.url] = u.link
         cache.set(cache_key, value, 60)
     return value
@@ -928,8 +1085,9 @@ def get_unique_map(user, force=False):
 
 class StreamContents(ReaderView):
     http_method_names = ['get']
-    renderer_classes = ReaderView.renderer_classes + [AtomRenderer,
-                                                      AtomHifiRenderer]
+    renderer_classes = [ReaderJSONRenderer, GoogleReaderXMLRenderer,
+                        AtomRenderer, AtomHifiRenderer]
+    streaming = True
 
     def get(self, request, *args, **kwargs):
         content_id = kwargs['content_id']
@@ -1016,29 +1174,28 @@ class StreamContents(ReaderView):
         ordering = ('date' if request.query_params.get('r', 'd') == 'o'
                     else '-date')
 
-        per_page, page = bounds(n=request.query_params.get('n'),
-                                c=request.query_params.get('c'))
+        per_page, page, after = bounds(n=request.query_params.get('n'),
+                                       c=request.query_params.get('c'))
         entries = get_es_entries(
             content_id, request.user,
             exclude=request.query_params.getlist('xt'),
             include=request.query_params.getlist('it'),
             limit=request.query_params.get('ot'),
             offset=request.query_params.get('nt'),
-        ).aggregate(
-            '__query__'
-        ).order_by(ordering.replace('date', 'timestamp')).fetch(
-            page=page, per_page=per_page, annotate=request.user)
-
-        continuation = continuation_(
-            entries['aggregations']['entries']['query']['doc_count'],
-            per_page,
-            page,
-        )
+        ).order_by(ordering.replace('date', 'timestamp'),
+                   ordering.replace('date', 'id'))
+        if after is not None:
+            entries = entries.search_after(after)
+        entries = entries.fetch(page=page, per_page=per_page,
+                                annotate=request.user, has_more=True,
+                                contents=False)
+
+        continuation = stream_continuation(entries)
         entries = entries['hits']
         start = max(0, (page - 1) * per_page)
 
         qs = {}
-        if start > 0:
+        if start > 0 or after is not None:
             qs['c'] = request.query_params['c']
 
         if 'output' in request.query_params:
@@ -1050,13 +1207,11 @@ class StreamContents(ReaderView):
         if continuation:
             base['continuation'] = continuation
 
-        forced = False  # Make at most 1 full refetch
-        for entry in entries:
-            if entry.feed.url not in uniques and not forced:
-                uniques = get_unique_map(request.user, force=True)
-                forced = True
-            item = serialize_entry(request, entry, uniques)
-            base['items'].append(item)
+        # Make at most 1 full refetch, before any item is serialized
+        if any(entry.feed.url not in uniques for entry in entries):
+            uniques = get_unique_map(request.user, force=True)
+        base['items'] = self.stream_items(ItemSerializer(request, uniques),
+                                          entries)
         return Response(base)
 
 
@@ -1065,6 +1220,8 @@ stream_contents = StreamContents.as_view()
 
 class StreamItemsIds(ReaderView):
     http_method_names = ['get', 'post']
+    renderer_classes = [ReaderJSONRenderer, GoogleReaderXMLRenderer]
+    conditional = True
     require_post_token = False
 
     def get(self, request, *args, **kwargs):
@@ -1077,8 +1234,8 @@ class StreamItemsIds(ReaderView):
             "includeAllDirectStreamIds") == 'true'
 
         data = {}
-        per_page, page = bounds(n=request.query_params.get('n'),
-                                c=request.query_params.get('c'))
+        per_page, page, after = bounds(n=request.query_params.get('n'),
+                                       c=request.query_params.get('c'))
         annotate = None
         if include_stream_ids:
             annotate = request.user
@@ -1088,14 +1245,12 @@ class StreamItemsIds(ReaderView):
             include=request.query_params.getlist('it'),
             limit=request.query_params.get('ot'),
             offset=request.query_params.get('nt'),
-        ).aggregate('__query__').only(
-            'timestamp', 'feed').fetch(page=page, per_page=per_page,
-                                       annotate=annotate)
-        continuation = continuation_(
-            entries['aggregations']['entries']['query']['doc_count'],
-            per_page,
-            page,
-        )
+        ).only('timestamp', 'feed')
+        if after is not None:
+            entries = entries.search_after(after)
+        entries = entries.fetch(page=page, per_page=per_page,
+                                annotate=annotate, has_more=True)
+        continuation = stream_continuation(entries)
         if continuation:
             data['continuation'] = continuation
 
@@ -1105,13 +1260,13 @@ class StreamItemsIds(ReaderView):
                 'directStreamIds': [
                     u'feed/{0}'.format(e.feed.url),
                 ],
-                'timestampUsec': e.date.strftime("%s000000"),
+                'timestampUsec': "{0}000000".format(utc_to_epoch(e.date)),
             } for e in entries['hits']]
         else:
             item_refs = [{
                 'id': str(e.pk),
                 'directStreamIds': [],
-                'timestampUsec': e.date.strftime("%s000000"),
+                'timestampUsec': "{0}000000".format(utc_to_epoch(e.date)),
             } for e in entries['hits']]
         data['itemRefs'] = item_refs
         return Response(data)
@@ -1144,9 +1299,10 @@ stream_items_count = StreamItemsCount.as_view()
 
 class StreamItemsContents(ReaderView):
     http_method_names = ['get', 'post']
-    renderer_classes = ReaderView.renderer_classes + [AtomRenderer,
-                                                      AtomHifiRenderer]
+    renderer_classes = [ReaderJSONRenderer, GoogleReaderXMLRenderer,
+                        AtomRenderer, AtomHifiRenderer]
     require_post_token = False
+    streaming = True
 
     def get(self, request, *args, **kwargs):
         items = request.query_params.getlist('i', list_attr(request.data, 'i'))
@@ -1156,27 +1312,26 @@ class StreamItemsContents(ReaderView):
 
         ids = list(map(item_id, items))
 
-        entries = es.mget(request.user, ids)
+        entries = es.mget(request.user, ids, contents=False)
 
         if not entries:
             raise exceptions.ParseError("No items found")
 
         uniques = get_unique_map(request.user)
-        items = []
-        for e in entries:
-            if e.feed.url not in uniques:
-                uniques = get_unique_map(request.user, force=True)
-            items.append(serialize_entry(request, e, uniques))
+        if any(e.feed.url not in uniques for e in entries):
+            uniques = get_unique_map(request.user, force=True)
+        feed = entries[0].feed
+        items = self.stream_items(ItemSerializer(request, uniques), entries)
 
         base = {
             'direction': 'ltr',
-            'id': u'feed/{0}'.format(entries[0].feed.url),
-            'title': entries[0].feed.name,
+            'id': u'feed/{0}'.format(feed.url),
+            'title': feed.name,
             'self': [{
                 'href': request.build_absolute_uri(),
             }],
             'alternate': [{
-                'href': uniques.get(entries[0].feed.url, entries[0].feed.url),
+                'href': uniques.get(feed.url, feed.url),
                 'type': 'text/html',
             }],
             'updated': int(timezone.now().strftime("%s")),
@@ -1250,6 +1405,10 @@ class EditTag(ReaderView):
                 raise exceptions.ParseError(
                     "Unrecognized tag: {0}".format(tag))
 
+        deltas = {}
+        if 'read' in query:
+            deltas = es.unread_deltas(request.user, entry_ids, query['read'])
+
         ops = []
         for pk in entry_ids:
             ops.append({
@@ -1262,6 +1421,7 @@ class EditTag(ReaderView):
         with es.ignore_bulk_error(404, 409):
             es.bulk(ops, index=index, raise_on_error=True,
                     params={'refresh': True})
+        request.user.incr_unread_counts(deltas)
         return Response("OK")
 
 
@@ -1275,7 +1435,6 @@ class MarkAllAsRead(ReaderView):
     def post(self, request, *args, **kwargs):
         if 's' not in request.data:
             raise exceptions.ParseError("Missing 's' parameter")
-        entries = request.user.entries
         es_entries = es.manager.user(request.user).filter(read=False)
         limit = None
         if 'ts' in request.data:
@@ -1316,21 +1475,13 @@ class MarkAllAsRead(ReaderView):
             logger.info("unknown stream", stream=stream, request=request)
             return Response("OK")
 
-        entries = es_entries.aggregate('id').fetch(per_page=0)
-        pks = [bucket['key'] for bucket in entries[
-            'aggregations']['entries']['query']['id']['buckets']]
+        deltas = defaultdict(int)
 
-        if pks:
-            ops = [{
-                '_op_type': 'update',
-                '_type': 'entries',
-                '_id': pk,
-                'doc': {'read': True},
-            } for pk in pks]
-            index = es.user_alias(request.user.pk)
-            with es.ignore_bulk_error(404, 409):
-                es.bulk(ops, index=index, raise_on_error=True,
-                        params={'refresh': True})
+        def count(hit):
+            deltas[hit['_source']['feed']] -= 1
+
+        es_entries.update({'read': True}, fields=['feed'], callback=count)
+        request.user.incr_unread_counts(deltas)
         return Response("OK")
 
 
@@ -1363,8 +1514,11 @@ class OPMLExport(ReaderView):
     def get(self, request, *args, **kwargs):
         response = render(
             request, 'profiles/opml_export.opml',
-            {'categories': request.user.categories.all(),
-             'orphan_feeds': request.user.feeds.filter(category__isnull=True)})
+            {'categories': request.user.categories.prefetch_related(
+                Prefetch('feeds',
+                         queryset=Feed.objects.prefetch_job_details())),
+             'orphan_feeds': request.user.feeds.filter(
+                 category__isnull=True).prefetch_job_details()})
         response['Content-Disposition'] = (
             'attachment; filename=feedhq-export.opml'
         )
@@ -21,6 +21,8 @@ DATABASES = {
 
 ES_NODES = os.environ.get('ES_NODES', 'localhost:9200').split()
 ES_INDEX = os.environ.get('ES_INDEX', 'feedhq')
+# Entry bodies are stored once per feed in a separate, shared index.
+ES_CONTENT_INDEX = os.environ.get('ES_CONTENT_INDEX', 'feedhq-content')
 # Aliases are created for each user for easy filtering / data isolation.
 # Alias template is .format()'ed with the user id as argument.
 ES_ALIAS_TEMPLATE = os.environ.get('ES_ALIAS_TEMPLATE', 'feedhq-{0}')
@@ -30,6 +32,9 @@ ES_SHARDS = int(os.environ.get('ES_SHARDS', 5))
 # Replicas can be changed at any time.
 ES_REPLICAS = int(os.environ.get('ES_REPLICAS', 1))
 
+# Feeds larger than this (in bytes, once decompressed) aren't downloaded.
+FEED_MAX_SIZE = int(os.environ.get('FEED_MAX_SIZE', 10 * 1024 * 1024))
+
 TIME_ZONE = 'UTC'
 
 LANGUAGE_CODE = 'en-us'
@@ -19,6 +19,27 @@ def get_redis_connection():
     return client
 
 
+COUNTERS_KEY = 'counters'
+
+
+def incr_counters(**counters):
+    """
+    Increments operational counters stored in a redis hash. Exposed by the
+    health endpoint.
+    """
+    redis = get_redis_connection()
+    with redis.pipeline() as pipe:
+        for name, amount in counters.items():
+            pipe.hincrby(COUNTERS_KEY, name, amount)
+        pipe.execute()
+
+
+def get_counters():
+    redis = get_redis_connection()
+    return {key.decode('utf-8'): int(value)
+            for key, value in redis.hgetall(COUNTERS_KEY).items()}
+
+
 def is_email(value):
     try:
         EmailValidator()(value)
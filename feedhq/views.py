@@ -13,7 +13,7 @@ from rq import Worker
 
 from .feeds.models import Feed, UniqueFeed
 from .profiles.models import User
-from .utils import get_redis_connection
+from .utils import get_counters, get_redis_connection
 
 
 def robots(request):
@@ -76,6 +76,7 @@ def health(request):
             'total': Feed.objects.all().count(),
             'unique': UniqueFeed.objects.all().count(),
         },
+        'counters': get_counters(),
     }
     response = HttpResponse(json.dumps(data))
     response['Content-Type'] = 'application/json'
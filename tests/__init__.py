@@ -1,5 +1,4 @@
 import os
-from io import BytesIO as BaseBytesIO
 from uuid import uuid4
 
 from django.test import TestCase as BaseTestCase
@@ -26,12 +25,6 @@ def _pretty_json(data):
 panel._pretty_json = _pretty_json
 
 
-class BytesIO(BaseBytesIO):
-    def read(self, *args, **kwargs):
-        kwargs.pop('decode_content', None)
-        return super().read(*args, **kwargs)
-
-
 def data_file(name):
     return os.path.join(TEST_DATA, name)
 
@@ -43,11 +36,14 @@ def responses(code, path=None, redirection=None, data=None,
         headers = {'Content-Type': 'text/xml'}
     response = Response()
     response.status_code = code
+    # Bodies are preloaded so that they can be streamed more than once
     if path is not None and redirection is None:
         with open(data_file(path), 'rb') as f:
-            response.raw = BytesIO(f.read())
+            response._content = f.read()
+        response._content_consumed = True
     elif data is not None:
         response._content = data.encode('utf-8')
+        response._content_consumed = True
     if redirection is not None:
         temp = Response()
         temp.status_code = 301 if 'permanent' in redirection else 302
@@ -9,13 +9,15 @@ from feedhq import es
 class ESTestSuiteRunner(DiscoverRunner):
     def setup_test_environment(self):
         super().setup_test_environment()
-        try:
-            es.client.indices.delete(settings.ES_INDEX)
-        except NotFoundError:
-            pass
+        for index in [settings.ES_INDEX, settings.ES_CONTENT_INDEX]:
+            try:
+                es.client.indices.delete(index)
+            except NotFoundError:
+                pass
         call_command('create_index')
         es.wait_for_yellow()
 
     def teardown_test_environment(self):
         super().teardown_test_environment()
         es.client.indices.delete(settings.ES_INDEX)
+        es.client.indices.delete(settings.ES_CONTENT_INDEX)
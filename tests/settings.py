@@ -37,6 +37,7 @@ if '-v2' not in sys.argv:
 MEDIA_ROOT = os.path.join(BASE_DIR, 'test_media')  # noqa
 
 ES_INDEX = 'test-feedhq'
+ES_CONTENT_INDEX = 'test-feedhq-content'
 ES_ALIAS_TEMPLATE = 'test-feedhq-{0}'
 ES_SHARDS = 1
 ES_REPLICAS = 0
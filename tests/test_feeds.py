@@ -614,6 +614,24 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertContains(response, 'Dashboard')
 
+    @patch('requests.get')
+    def test_stars_dashboard(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        feed = FeedFactory.create(category__user=user, user=user)
+        empty = FeedFactory.create(category__user=user, user=user)
+        EntryFactory.create(feed=feed, user=user, starred=True)
+        EntryFactory.create(feed=feed, user=user)
+
+        counts = es.counts(user, [feed.pk, empty.pk], stars=True)
+        self.assertEqual(counts[feed.pk], 1)
+        self.assertEqual(counts[empty.pk], 0)
+        self.assertEqual(es.counts(user, [feed.pk])[feed.pk], 2)
+
+        url = reverse('feeds:dashboard', args=["stars"])
+        response = self.app.get(url, user=user)
+        self.assertContains(response, 'Dashboard')
+
     @patch('requests.get')
     def test_unread_dashboard(self, get):
         get.return_value = responses(304)
@@ -739,7 +757,7 @@ class WebBaseTests(WebTest):
             feed.url,
             headers={'User-Agent': USER_AGENT % '1 subscriber',
                      'Accept': feedparser.ACCEPT_HEADER},
-            timeout=10, auth=None)
+            timeout=10, auth=None, stream=True)
 
         entry_pk = es.manager.user(user).fetch()['hits'][0].pk
         url = reverse('feeds:item', args=[entry_pk])
@@ -777,7 +795,7 @@ class WebBaseTests(WebTest):
             feed.url,
             headers={'User-Agent': USER_AGENT % '1 subscriber',
                      'Accept': feedparser.ACCEPT_HEADER},
-            timeout=10, auth=None)
+            timeout=10, auth=None, stream=True)
 
         entry_pk = es.manager.user(user).fetch()['hits'][0].pk
         url = reverse('feeds:item', args=[entry_pk])
@@ -809,7 +827,7 @@ class WebBaseTests(WebTest):
         get.assert_called_with(
             url, headers={'User-Agent': USER_AGENT % '1 subscriber',
                           'Accept': feedparser.ACCEPT_HEADER},
-            timeout=10, auth=None)
+            timeout=10, auth=None, stream=True)
 
         self.assertEqual(feed.entries.count(), 0)
         path = data_file('bruno.im.atom')
@@ -1003,6 +1021,7 @@ class WebBaseTests(WebTest):
             response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         expected = {
+            'counters': {},
             'feeds': {'total': 0, 'unique': 0},
             'queues': {},
             'users': {'active': 0, 'total': 0},
@@ -1043,7 +1062,7 @@ class WebBaseTests(WebTest):
             with open(data_file(file_name), 'r') as f:
                 content = f.read()
 
-            entry = EsEntry({'_id': 1, '_source': {'content': content}})
+            entry = EsEntry({'_id': None, '_source': {'content': content}})
             entry.feed = FeedFactory.create()
             self.assertTrue(entry.sanitized_content())
 
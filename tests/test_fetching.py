@@ -1,5 +1,6 @@
+import codecs
 import socket
-from unittest.mock import patch, PropertyMock
+from unittest.mock import patch
 
 import feedparser
 from django.core.management import call_command
@@ -7,7 +8,8 @@ from django.utils import timezone
 from feedhq import es
 from feedhq.feeds.models import Favicon, Feed, UniqueFeed
 from feedhq.feeds.tasks import update_feed
-from feedhq.feeds.utils import epoch_to_utc, FAVICON_FETCHER, USER_AGENT
+from feedhq.feeds.utils import (epoch_to_utc, FAVICON_FETCHER,
+                                looks_like_markup, USER_AGENT)
 from feedhq.utils import get_redis_connection
 from rache import job_details, schedule_job
 from requests import RequestException
@@ -52,13 +54,46 @@ class UpdateTests(TestCase):
     @patch("requests.get")
     def test_socket_timeout(self, get):
         m = get.return_value
-        type(m).content = PropertyMock(side_effect=socket.timeout)
+        m.iter_content.side_effect = socket.timeout
         FeedFactory.create()
         f = UniqueFeed.objects.get()
         self.assertFalse(f.muted)
         data = job_details(f.url, connection=get_redis_connection())
         self.assertEqual(data['error'], f.TIMEOUT)
 
+    @patch("requests.get")
+    def test_too_large(self, get):
+        get.return_value = responses(200, 'sw-all.xml', headers={
+            'Content-Type': 'text/xml', 'Content-Length': '999999999'})
+        FeedFactory.create()
+        f = UniqueFeed.objects.get()
+        self.assertFalse(f.muted)
+        data = job_details(f.url, connection=get_redis_connection())
+        self.assertEqual(data['error'], f.TOO_LARGE)
+        self.assertEqual(data['backoff_factor'], f.MAX_BACKOFF)
+
+        # Missing or lying Content-Length
+        get.return_value = responses(200, 'sw-all.xml')
+        with self.settings(FEED_MAX_SIZE=1000):
+            feed = FeedFactory.create()
+        data = job_details(feed.url, connection=get_redis_connection())
+        self.assertEqual(data['error'], f.TOO_LARGE)
+
+    @patch("requests.get")
+    def test_unexpected_content(self, get):
+        get.return_value = responses(200, data='GIF89a\x00\x01',
+                                     headers={'Content-Type': 'image/gif'})
+        FeedFactory.create()
+        f = UniqueFeed.objects.get()
+        data = job_details(f.url, connection=get_redis_connection())
+        self.assertEqual(data['error'], f.UNEXPECTED_CONTENT)
+        self.assertEqual(data['backoff_factor'], f.MAX_BACKOFF)
+
+        self.assertTrue(looks_like_markup(b'  \n<?xml version="1.0"?>'))
+        self.assertTrue(looks_like_markup(codecs.BOM_UTF8 + b'<rss>'))
+        self.assertTrue(looks_like_markup('<rss>'.encode('utf-16')))
+        self.assertFalse(looks_like_markup(b'%PDF-1.4'))
+
     @patch("requests.get")
     def test_invalid_url(self, get):
         FeedFactory.create(url='feed/')
@@ -78,7 +113,7 @@ class UpdateTests(TestCase):
             feed.url,
             headers={'User-Agent': USER_AGENT % '1 subscriber',
                      'Accept': feedparser.ACCEPT_HEADER},
-            timeout=10, auth=None)
+            timeout=10, auth=None, stream=True)
 
         get.return_value = responses(200, 'sw-all.xml',
                                      headers={'Content-Type': None})
@@ -87,7 +122,7 @@ class UpdateTests(TestCase):
             feed.url,
             headers={'User-Agent': USER_AGENT % '1 subscriber',
                      'Accept': feedparser.ACCEPT_HEADER},
-            timeout=10, auth=None)
+            timeout=10, auth=None, stream=True)
 
     @patch('requests.head')
     @patch('requests.get')
@@ -109,7 +144,7 @@ class UpdateTests(TestCase):
             headers={'Content-Type': 'application/rss+xml'})
         feed = FeedFactory.create()
         get.assert_called_with(
-            feed.url, timeout=10, auth=None,
+            feed.url, timeout=10, auth=None, stream=True,
             headers={'User-Agent': USER_AGENT % '1 subscriber',
                      'Accept': feedparser.ACCEPT_HEADER},
         )
@@ -267,7 +302,7 @@ class UpdateTests(TestCase):
                 'If-None-Match': b'etag',
                 'If-Modified-Since': b'1234',
                 'A-IM': b'feed',
-            }, timeout=10, auth=None)
+            }, timeout=10, auth=None, stream=True)
 
     @patch("requests.get")
     def test_restore_backoff(self, get):
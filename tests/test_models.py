@@ -2,15 +2,16 @@
 from datetime import timedelta
 from unittest.mock import patch
 
+import bleach
 from django.utils import timezone
 from feedhq import es
-from feedhq.feeds.models import (Category, Entry, Favicon, Feed, UniqueFeed,
-                                 UniqueFeedManager)
+from feedhq.feeds.models import (Category, Entry, EsEntry, Favicon, Feed,
+                                 UniqueFeed, UniqueFeedManager)
 from feedhq.feeds.tasks import update_feed
 from feedhq.utils import get_redis_connection
 from rache import job_details, schedule_job
 
-from . import responses, TestCase
+from . import data_file, responses, TestCase
 from .factories import CategoryFactory, FeedFactory
 
 
@@ -180,3 +181,35 @@ class ModelTests(TestCase):
     def test_not_scheduled_last_update(self):
         u = UniqueFeed('ĥttp://example.com')
         self.assertIsNone(u.last_update)
+
+    def test_sanitizer(self):
+        for name in ['break-bleach.html', 'break-bleach2.html']:
+            with open(data_file(name), 'r') as f:
+                content = f.read()
+            entry = EsEntry({'_id': None, '_source': {'content': content}})
+            entry.feed = Feed(url='http://example.com/feed')
+            self.assertEqual(entry.sanitized_content(), bleach.clean(
+                entry.content, tags=EsEntry.ELEMENTS,
+                attributes=EsEntry.ATTRIBUTES,
+                styles=EsEntry.CSS_PROPERTIES, strip=True))
+            self.assertEqual(entry.sanitized_nomedia_content(), bleach.clean(
+                entry.content, tags=EsEntry.ELEMENTS - EsEntry.MEDIA_ELEMENTS,
+                attributes=EsEntry.ATTRIBUTES,
+                styles=EsEntry.CSS_PROPERTIES, strip=True))
+
+        entry = EsEntry({'_id': 12, '_source': {
+            'content': '<p>Hello <img src="/a.png"><script>x</script></p>',
+            'title': '<b>Title</b> &amp; more',
+        }})
+        entry.feed = Feed(url='http://example.com/feed')
+        self.assertEqual(entry.sanitized_title(), 'Title & more')
+        full = entry.sanitized_content()
+        self.assertIn('http://example.com/a.png', full)
+        nomedia = entry.sanitized_nomedia_content()
+        self.assertNotIn('img', nomedia)
+
+        # Served from the cache for that entry and policy
+        entry.subtitle = '<p>Changed</p>'
+        entry._content = entry.subtitle
+        self.assertEqual(entry.sanitized_content(), full)
+        self.assertEqual(entry.sanitized_nomedia_content(), nomedia)
@@ -6,13 +6,17 @@ from unittest.mock import patch
 from django.core.cache import cache
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from django.test import Client
+from django.test import Client, RequestFactory
 from django.utils import timezone
+from django.utils.http import parse_http_date
 from feedhq import es
 from feedhq.feeds.models import Entry, Feed, UniqueFeed
 from feedhq.reader.models import AuthToken
-from feedhq.reader.views import GoogleReaderXMLRenderer, item_id
+from feedhq.reader.renderers import AtomRenderer, ReaderJSONRenderer
+from feedhq.reader.views import (GoogleReaderXMLRenderer, item_id,
+                                 ItemSerializer, serialize_entry)
 from feedhq.utils import get_redis_connection
+from rest_framework.renderers import JSONRenderer
 from six.moves.urllib.parse import urlencode
 
 from . import data_file, responses, TestCase
@@ -31,7 +35,7 @@ def clientlogin(token):
 class ApiClient(Client):
     def request(self, **request):
         response = super().request(**request)
-        if response['Content-Type'] == 'application/json':
+        if response.get('Content-Type') == 'application/json':
             response.json = json.loads(response.content.decode('utf-8'))
         return response
 
@@ -172,6 +176,41 @@ class SerializerTest(ApiTest):
         with self.assertRaises(AssertionError):
             serializer.render(12.5)
 
+    def test_streaming_renderers(self):
+        entry = {
+            'crawlTimeMsec': '1400000000000',
+            'id': 'tag:google.com,2005:reader/item/00000000000000ff',
+            'categories': ['user/1/state/com.google/reading-list',
+                           'user/1/label/Tech'],
+            'title': 'Entry <title>',
+            'updated': 1400000000,
+            'alternate': [{'href': 'http://example.com/1',
+                           'type': 'text/html'}],
+            'content': {'direction': 'ltr', 'content': '<p>Hello</p>'},
+            'author': 'Someone',
+            'origin': {'streamId': 'feed/http://example.com/feed',
+                       'title': 'Example',
+                       'htmlUrl': 'http://example.com'},
+        }
+        data = {
+            'direction': 'ltr',
+            'id': 'feed/http://example.com/feed',
+            'title': 'Example',
+            'self': [{'href': 'http://testserver/reader/atom/'}],
+            'updated': 1400000000,
+            'continuation': 'abc',
+            'items': [entry, dict(entry, id='other')],
+        }
+        for renderer in [AtomRenderer(), GoogleReaderXMLRenderer()]:
+            chunks = list(renderer.stream(dict(data)))
+            self.assertGreater(len(chunks), 2)
+            self.assertEqual(b''.join(chunks).decode('utf-8'),
+                             renderer.render(dict(data)))
+
+            lazy = dict(data, items=(item for item in data['items']))
+            self.assertEqual(b''.join(renderer.stream(lazy)).decode('utf-8'),
+                             renderer.render(dict(data)))
+
 
 @patch('requests.head')
 @patch('requests.get')
@@ -429,6 +468,48 @@ class ReaderApiTest(ApiTest):
             response = self.client.get(url, **clientlogin(token))
         self.assertEqual(len(response.json['tags']), 3)
 
+    def test_cached_subscriptions(self, get, head):
+        head.return_value = responses(200)
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        feed = FeedFactory.create(category__user=user, user=user)
+        subscriptions = reverse("reader:subscription_list")
+        tags = reverse('reader:tag_list')
+
+        with self.assertNumQueries(2):
+            response = self.client.get(subscriptions, **clientlogin(token))
+        with self.assertNumQueries(1):
+            self.client.get(tags, **clientlogin(token))
+        with self.assertNumQueries(0):
+            cached = self.client.get(subscriptions, **clientlogin(token))
+            self.client.get(tags, **clientlogin(token))
+        self.assertEqual(cached.json, response.json)
+
+        # Edits are queryset updates
+        url = reverse('reader:subscription_edit')
+        response = self.client.post(url, {
+            'T': self.post_token(token),
+            's': 'feed/{0}'.format(feed.url),
+            'ac': 'edit',
+            't': 'Renamed',
+        }, **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(subscriptions, **clientlogin(token))
+        self.assertEqual(response.json['subscriptions'][0]['title'],
+                         'Renamed')
+
+        url = reverse('reader:rename_tag')
+        response = self.client.post(url, {
+            'T': self.post_token(token),
+            't': feed.category.name,
+            'dest': 'user/{0}/label/Other'.format(user.pk),
+        }, **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(tags, **clientlogin(token))
+        self.assertEqual(response.json['tags'][2]['id'],
+                         'user/{0}/label/Other'.format(user.pk))
+
     def test_unread_count(self, get, head):
         head.return_value = responses(200)
         get.return_value = responses(304)
@@ -500,7 +581,9 @@ class ReaderApiTest(ApiTest):
         self.assertEqual(response.status_code, 400)
 
         response = self.client.get(url, {'c': 'pageone'}, **clientlogin(token))
+        self.assertEqual(response.status_code, 400)
         response = self.client.get(url, {'c': 'a'}, **clientlogin(token))
+        self.assertEqual(response.status_code, 400)
 
         feed = FeedFactory.create(category__user=user, user=user)
         FeedFactory.create(category=feed.category, user=user, url=feed.url)
@@ -525,7 +608,7 @@ class ReaderApiTest(ApiTest):
         # Warm up the uniques map cache
         with self.assertNumQueries(2):
             response = self.client.get(url, **clientlogin(token))
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue(response.json['continuation'])
         self.assertEqual(len(response.json['items']), 20)
 
         # ?xt= excludes stuff
@@ -598,11 +681,39 @@ class ReaderApiTest(ApiTest):
         self.assertTrue(response.json['self'][0]['href'].endswith(
             'reading-list?c=page2'))
 
+        # Walk the stream with continuations, both orderings
+        for order in ['d', 'o']:
+            seen = []
+            params = {'n': 7, 'r': order}
+            while True:
+                response = self.client.get(url, params, **clientlogin(token))
+                seen.extend([item['id'] for item in response.json['items']])
+                if 'continuation' not in response.json:
+                    break
+                params['c'] = response.json['continuation']
+            self.assertEqual(len(seen), 30)
+            self.assertEqual(len(set(seen)), 30)
+
         with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 30)
         self.assertFalse('continuation' in response.json)
 
+        # Exactly one page left: no continuation
+        response = self.client.get(url, {'n': 30}, **clientlogin(token))
+        self.assertEqual(len(response.json['items']), 30)
+        self.assertFalse('continuation' in response.json)
+
+        params = {'n': 10}
+        pages = []
+        while True:
+            response = self.client.get(url, params, **clientlogin(token))
+            pages.append(len(response.json['items']))
+            if 'continuation' not in response.json:
+                break
+            params['c'] = response.json['continuation']
+        self.assertEqual(pages, [10, 10, 10])
+
         with self.assertNumQueries(1):
             response = self.client.get(url, {
                 'n': 100,
@@ -717,6 +828,10 @@ class ReaderApiTest(ApiTest):
         with self.assertNumQueries(2):
             response = self.client.get(url, **clientlogin(token))
         self.assertTrue(response['Content-Type'].startswith("text/xml"))
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(b'<?xml'))
+        self.assertTrue(content.endswith(b'</feed>'))
 
         response = self.client.get(url, {'output': 'json'},
                                    **clientlogin(token))
@@ -750,7 +865,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'})),
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue(response.json['continuation'])
 
         with self.assertNumQueries(1):
             response = self.client.post('{0}?{1}'.format(url, urlencode({
@@ -759,7 +874,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'})),
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue(response.json['continuation'])
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {
@@ -767,7 +882,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'},
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue(response.json['continuation'])
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {
@@ -777,7 +892,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'},
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue(response.json['continuation'])
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {
@@ -843,6 +958,31 @@ class ReaderApiTest(ApiTest):
             **clientlogin(token))
         self.assertTrue(response.content.startswith(b'4#'))
 
+    def test_item_serializer(self, get, head):
+        head.return_value = responses(200)
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        feed = FeedFactory.create(category__user=user, user=user)
+        other = FeedFactory.create(category=None, user=user)
+        entries = [
+            EntryFactory.create(feed=feed, user=user, read=True,
+                                author=u'Jürgen'),
+            EntryFactory.create(feed=feed, user=user, starred=True,
+                                broadcast=True, title=u'Caf\u2028é / <b>'),
+            EntryFactory.create(feed=other, user=user),
+        ]
+        request = RequestFactory().get('/')
+        request.user = user
+        uniques = {feed.url: 'http://example.com'}
+
+        serialize = ItemSerializer(request, uniques)
+        for entry in es.mget(user, [e.pk for e in entries]):
+            expected = JSONRenderer().render(
+                serialize_entry(request, entry, uniques))
+            item = serialize(entry)
+            self.assertEqual(JSONRenderer().render(item), expected)
+            self.assertEqual(ReaderJSONRenderer().render(item), expected)
+
     def test_stream_items_contents(self, get, head):
         head.return_value = responses(200)
         get.return_value = responses(304)
@@ -911,6 +1051,146 @@ class ReaderApiTest(ApiTest):
                       'output': 'atom-hifi'}, **clientlogin(token))
             self.assertEqual(response.status_code, 200)
 
+    def test_unread_counters(self, get, head):
+        head.return_value = responses(200)
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        post_token = self.client.post(
+            reverse('reader:token'),
+            **clientlogin(token)).content.decode('utf-8')
+
+        feed = FeedFactory.create(category__user=user, user=user)
+        feed2 = FeedFactory.create(category__user=user, user=user)
+        self.assertEqual(user.unread_counts(), {})
+
+        entries = [EntryFactory.create(feed=feed, user=user)
+                   for _ in range(3)]
+        EntryFactory.create(feed=feed2, user=user)
+        self.assertEqual(user.unread_counts(), {feed.pk: 3, feed2.pk: 1})
+
+        response = self.client.post(reverse('reader:edit_tag'), {
+            'T': post_token,
+            'i': 'tag:google.com,2005:reader/item/{0}'.format(
+                entries[0].hex_pk),
+            'a': 'user/-/state/com.google/read',
+        }, **clientlogin(token))
+        self.assertContains(response, 'OK')
+        self.assertEqual(user.unread_counts(), {feed.pk: 2, feed2.pk: 1})
+
+        response = self.client.post(reverse('reader:mark_all_as_read'), {
+            'T': post_token,
+            's': u'feed/{0}'.format(feed.url),
+        }, **clientlogin(token))
+        self.assertContains(response, 'OK')
+        self.assertEqual(user.unread_counts(), {feed2.pk: 1})
+        self.assertEqual(user.unread_count, 1)
+        self.assertEqual(user.rebuild_unread_counts(), {feed2.pk: 1})
+
+        user.delete_feed_entries(feed2.pk)
+        self.assertEqual(user.unread_counts(), {})
+
+    def test_conditional_requests(self, get, head):
+        head.return_value = responses(200)
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        post_token = self.post_token(token)
+        feed = FeedFactory.create(category__user=user, user=user)
+        entry = EntryFactory.create(feed=feed, user=user)
+
+        urls = [
+            (reverse('reader:unread_count'), {}),
+            (reverse('reader:subscription_list'), {}),
+            (reverse('reader:tag_list'), {}),
+            (reverse('reader:stream_items_ids'),
+             {'n': 10, 's': 'user/-/state/com.google/reading-list'}),
+        ]
+        etags = {}
+        for url, params in urls:
+            response = self.client.get(url, params, **clientlogin(token))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Last-Modified'])
+            etags[url] = response['ETag']
+
+            with patch.object(es.client, 'search') as search:
+                response = self.client.get(
+                    url, params, HTTP_IF_NONE_MATCH=response['ETag'],
+                    **clientlogin(token))
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+                self.assertEqual(response['ETag'], etags[url])
+
+                response = self.client.get(
+                    url, params,
+                    HTTP_IF_MODIFIED_SINCE=response['Last-Modified'],
+                    **clientlogin(token))
+                self.assertEqual(response.status_code, 304)
+            self.assertFalse(search.called)
+
+        # Representations differ per output format
+        url, params = urls[0]
+        response = self.client.get(url, dict(params, output='xml'),
+                                   **clientlogin(token))
+        self.assertNotEqual(response['ETag'], etags[url])
+
+        # Marking an entry as read changes the version
+        response = self.client.post(reverse('reader:edit_tag'), {
+            'T': post_token,
+            'i': 'tag:google.com,2005:reader/item/{0}'.format(entry.hex_pk),
+            'a': 'user/-/state/com.google/read',
+        }, **clientlogin(token))
+        self.assertContains(response, 'OK')
+        for url, params in urls:
+            response = self.client.get(url, params,
+                                       HTTP_IF_NONE_MATCH=etags[url],
+                                       **clientlogin(token))
+            self.assertEqual(response.status_code, 200)
+            etags[url] = response['ETag']
+
+        # The ETag wins over the less precise date
+        url, params = urls[0]
+        self.assertLessEqual(parse_http_date(response['Last-Modified']),
+                             time.time())
+        response = self.client.get(
+            url, params, HTTP_IF_NONE_MATCH='"stale"',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'],
+            **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+
+        # So do subscription changes and new entries
+        version = user.version()
+        feed.name = 'Renamed'
+        feed.save()
+        self.assertGreater(user.version(), version)
+
+        version = user.version()
+        EntryFactory.create(feed=feed, user=user)
+        self.assertGreater(user.version(), version)
+
+    @patch('feedhq.es.SCAN_PAGE_SIZE', 2)
+    def test_mark_all_as_read_pages(self, get, head):
+        head.return_value = responses(200)
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        post_token = self.client.post(
+            reverse('reader:token'),
+            **clientlogin(token)).content.decode('utf-8')
+
+        feed = FeedFactory.create(category__user=user, user=user)
+        for _ in range(7):
+            EntryFactory.create(feed=feed, user=user)
+        self.assertEqual(user.unread_counts(), {feed.pk: 7})
+
+        response = self.client.post(reverse('reader:mark_all_as_read'), {
+            'T': post_token,
+            's': 'user/-/state/com.google/reading-list',
+        }, **clientlogin(token))
+        self.assertContains(response, 'OK')
+        self.assertEqual(self.counts(user, read={'read': True})['read'], 7)
+        self.assertEqual(user.unread_counts(), {})
+
     def test_mark_all_as_read(self, get, head):
         head.return_value = responses(200)
         get.return_value = responses(304)
@@ -1,20 +1,27 @@
+import calendar
 import time
 from datetime import timedelta
+from io import StringIO
 from unittest.mock import patch
 
 import feedparser
+from django.conf import settings
 from django.core.cache import cache
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TransactionTestCase
 from django.utils import timezone
 from django_push.subscriber.models import Subscription
 from feedhq import es
-from feedhq.feeds.models import timedelta_to_seconds, UniqueFeed
-from feedhq.feeds.tasks import store_entries
-from feedhq.feeds.utils import USER_AGENT
+from feedhq.feeds.fetcher import due_jobs, Fetcher, TokenBucket
+from feedhq.feeds.models import (BaseEntry, EsEntry, prefetch_job_details,
+                                 timedelta_to_seconds, UniqueFeed)
+from feedhq.feeds.tasks import seen_key, store_entries
+from feedhq.feeds.utils import (content_fingerprint, JobNotFound, Sanitizer,
+                                USER_AGENT)
 from feedhq.profiles.models import User
-from feedhq.utils import get_redis_connection
-from rache import delete_job, pending_jobs
+from feedhq.utils import get_counters, get_redis_connection
+from rache import delete_job, pending_jobs, REDIS_KEY, scheduled_jobs
 from rq.utils import utcformat, utcnow
 
 from . import data_file, patch_job, resolve_url, responses, TestCase
@@ -22,6 +29,11 @@ from .factories import FeedFactory, UserFactory
 
 
 class UpdateTests(TestCase):
+    def entries_data(self, name):
+        parsed = feedparser.parse(data_file(name))
+        return list(filter(None, [UniqueFeed.objects.entry_data(entry, parsed)
+                                  for entry in parsed.entries]))
+
     def test_update_feeds(self):
         u = UniqueFeed.objects.create(
             url='http://example.com/feed0',
@@ -131,7 +143,7 @@ class UpdateTests(TestCase):
             'http://example.com/test',
             headers={'Accept': feedparser.ACCEPT_HEADER,
                      'User-Agent': USER_AGENT % '1 subscriber'},
-            timeout=10, auth=None)
+            timeout=10, auth=None, stream=True)
 
         call_command('delete_unsubscribed')
         self.assertEqual(UniqueFeed.objects.count(), 1)
@@ -175,6 +187,167 @@ class UpdateTests(TestCase):
             # count()
             call_command('updatefeeds')
 
+    @patch("requests.get")
+    def test_sync_scheduler(self, get):
+        get.return_value = responses(304)
+        for _ in range(5):
+            FeedFactory.create()
+        urls = list(UniqueFeed.objects.values_list('url', flat=True))
+        patch_job(urls[0], backoff_factor=3)
+        redis = get_redis_connection()
+        for url in urls:
+            redis.zrem(REDIS_KEY, url)
+        redis.zadd(REDIS_KEY, 'http://example.com/stale', int(time.time()))
+
+        call_command('sync_scheduler')
+        self.assertEqual(set(scheduled_jobs(connection=redis)), set(urls))
+        unique = UniqueFeed.objects.get(url=urls[0])
+        self.assertEqual(unique.job_details['backoff_factor'], 3)
+        self.assertTrue(unique.job_details['schedule_at'] > time.time())
+
+    def test_prefetch_job_details(self):
+        uniques = [UniqueFeed.objects.create(
+            url='http://example.com/feed{0}'.format(i)) for i in range(3)]
+        UniqueFeed.objects.bulk_schedule(uniques[:2])
+
+        uniques = prefetch_job_details(UniqueFeed.objects.order_by('url'))
+        with patch('feedhq.feeds.models.get_job') as get_job:
+            self.assertEqual(uniques[0].job_details['subscribers'], 1)
+            self.assertEqual(uniques[1].job_details['backoff_factor'], 1)
+            with self.assertRaises(JobNotFound):
+                uniques[2].job_details
+            self.assertEqual(uniques[2].link, uniques[2].url)
+            self.assertFalse(get_job.called)
+
+    @patch("requests.get")
+    def test_prefetch_job_details_queryset(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        for _ in range(3):
+            FeedFactory.create(user=user, category__user=user)
+
+        feeds = user.feeds.filter(
+            category__isnull=False).prefetch_job_details()
+        with patch('feedhq.feeds.models.get_job') as get_job:
+            self.assertEqual(len(feeds), 3)
+            for feed in feeds[:2]:
+                self.assertEqual(feed.job_details['subscribers'], 1)
+            for feed in feeds:
+                self.assertTrue(feed.link)
+            self.assertFalse(get_job.called)
+
+    @patch("requests.Session.get")
+    @patch("requests.get")
+    def test_fetchfeeds(self, get, session_get):
+        get.return_value = responses(304)
+        session_get.return_value = responses(304)
+
+        for _ in range(6):
+            f = FeedFactory.create()
+            patch_job(f.url, last_update=(
+                timezone.now() - timedelta(hours=10)).strftime('%s'))
+            UniqueFeed.objects.get(url=f.url).schedule()
+        self.assertEqual(get.call_count, 6)
+
+        # Fetches go through per-host sessions
+        call_command('fetchfeeds', concurrency=3, limit=10, host_rate=100)
+        self.assertEqual(get.call_count, 6)
+        self.assertEqual(session_get.call_count, 6)
+        for unique in UniqueFeed.objects.all():
+            self.assertTrue(
+                unique.job_details['last_update'] > time.time() - 60)
+
+        # Nothing left to fetch
+        call_command('fetchfeeds', concurrency=3, limit=10)
+        self.assertEqual(session_get.call_count, 6)
+
+    @patch("requests.Session.get")
+    @patch("requests.get")
+    def test_fetchfeeds_deadline(self, get, session_get):
+        get.return_value = responses(304)
+        session_get.return_value = responses(304)
+
+        for _ in range(3):
+            f = FeedFactory.create()
+            patch_job(f.url, last_update=(
+                timezone.now() - timedelta(hours=10)).strftime('%s'))
+            UniqueFeed.objects.get(url=f.url).schedule()
+
+        # Unstarted feeds go back to the scheduler
+        call_command('fetchfeeds', limit=10, deadline=0)
+        self.assertEqual(session_get.call_count, 0)
+        for unique in UniqueFeed.objects.all():
+            self.assertTrue(
+                unique.job_details['schedule_at'] <= time.time())
+
+        call_command('fetchfeeds', limit=10)
+        self.assertEqual(session_get.call_count, 3)
+
+        # Failed runs too
+        for unique in UniqueFeed.objects.all():
+            unique.schedule(schedule_in=0)
+        jobs = list(due_jobs(10))
+        with patch.object(Fetcher, 'drain', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                Fetcher().run(jobs)
+        self.assertEqual(len(list(due_jobs(10))), 3)
+
+    def test_fetcher_hosts(self):
+        fetcher = Fetcher(per_host=2)
+        hosts = fetcher.hosts([
+            ('http://a.example.com/1', {}),
+            ('http://a.example.com/2', {}),
+            ('https://A.example.com:8443/3', {}),
+            ('http://b.example.com/1', {}),
+            ('not a url', {}),
+        ])
+        self.assertEqual(list(hosts), ['a.example.com', 'b.example.com', ''])
+        self.assertEqual(len(hosts['a.example.com'].jobs), 3)
+        lanes = [host.name for host in fetcher.lanes(hosts)]
+        self.assertEqual(lanes, ['a.example.com', 'b.example.com', '',
+                                 'a.example.com'])
+        for host in hosts.values():
+            host.close()
+
+    def test_token_bucket(self):
+        now = [0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1)
+        now[0] = 10
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_bench_ingest(self):
+        out = StringIO()
+        # Test services may run on other hosts
+        with patch('feedhq.feeds.management.commands.bench_ingest.'
+                   'remote_services', return_value=[]):
+            call_command('bench_ingest', data_file('sw-all.xml'),
+                         data_file('atom10.xml'), rounds=2, subscribers=2,
+                         allocations=True, stdout=out)
+        output = out.getvalue()
+        self.assertIn('4 feeds', output)
+        self.assertIn('feeds/s', output)
+        self.assertIn('store_entries', output)
+        self.assertIn('peak traced memory', output)
+
+        # Temporary subscribers and jobs are gone
+        self.assertEqual(User.objects.count(), 0)
+        self.assertEqual(UniqueFeed.objects.count(), 0)
+        self.assertEqual(list(scheduled_jobs(
+            connection=get_redis_connection())), [])
+
+        # Only runs against local services unless DEBUG is on
+        with self.settings(ES_NODES=['http://es.example.com:9200']):
+            with self.assertRaises(CommandError) as context:
+                call_command('bench_ingest', rounds=1)
+            self.assertIn('elasticsearch', str(context.exception))
+            with self.settings(DEBUG=True):
+                call_command('bench_ingest', data_file('sw-all.xml'),
+                             rounds=1, stdout=StringIO())
+
     @patch('requests.head')
     def test_utm_tags_guid(self, head):
         head.side_efect = resolve_url
@@ -216,18 +389,338 @@ class UpdateTests(TestCase):
             [UniqueFeed.objects.entry_data(
                 entry, parsed) for entry in parsed.entries]
         ))
-        with self.assertNumQueries(30 + 1):  # insert
+        with self.assertNumQueries(2):  # select + ID allocation
             store_entries(feed.url, data)
 
-        count = es.counts(
-            feed.user, [feed.pk])[str(feed.pk)][str(feed.pk)]['doc_count']
-        count2 = es.counts(
-            feed2.user, [feed2.pk])[str(feed2.pk)][str(feed2.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk])[feed.pk]
+        count2 = es.counts(feed2.user, [feed2.pk])[feed2.pk]
         self.assertEqual(count, 0)
         self.assertEqual(count2, 30)
         last_updates = feed2.user.last_updates()
         self.assertEqual(list(last_updates.keys()), [feed2.url])
 
+    def test_mapping_check(self):
+        es.verify_mapping(force=True)
+        with patch.object(es.client.indices, 'get_field_mapping') as mapping:
+            es.verify_mapping()
+            self.assertFalse(mapping.called)
+
+            mapping.return_value = {
+                settings.ES_INDEX: {'mappings': {'entries': {}}},
+            }
+            with self.assertRaises(es.MappingError):
+                es.verify_mapping(force=True)
+
+    @patch('feedhq.feeds.tasks.FANOUT_CHUNK_SIZE', 2)
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_store_fan_out(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        others = [FeedFactory.create(url=feed.url, user__ttl=99999)
+                  for _ in range(4)]
+
+        data = self.entries_data('sw-all.xml')
+        store_entries(feed.url, data)
+
+        for f in [feed] + others:
+            self.assertEqual(self.counts(f.user, all={})['all'], 30)
+        counters = get_counters()
+        self.assertEqual(counters['store_fanouts'], 1)
+        self.assertEqual(counters['store_fanout_jobs'], 3)
+
+    @patch('feedhq.feeds.tasks.FANOUT_CHUNK_SIZE', 2)
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_store_fan_out_marks(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        for _ in range(4):
+            FeedFactory.create(url=feed.url, user__ttl=99999)
+        data = self.entries_data('sw-all.xml')
+        redis = get_redis_connection()
+
+        with patch('feedhq.feeds.tasks.enqueue') as enqueue:
+            store_entries(feed.url, data, mark={'hwm': 1, 'recent': 'a'})
+        self.assertEqual(enqueue.call_count, 3)
+
+        # Nothing is marked until every sub-job has stored its entries
+        for _args, kwargs in enqueue.call_args_list[:2]:
+            store_entries(*kwargs['args'], **kwargs['kwargs'])
+        self.assertEqual(redis.zcard(seen_key(feed.url)), 0)
+        self.assertNotIn('hwm', UniqueFeed.objects.get().job_details)
+
+        [(args, kwargs)] = enqueue.call_args_list[2:]
+        store_entries(*kwargs['args'], **kwargs['kwargs'])
+        self.assertEqual(redis.zcard(seen_key(feed.url)), 30)
+        self.assertEqual(UniqueFeed.objects.get().job_details['hwm'], 1)
+
+    @patch('feedhq.feeds.models.enqueue')
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_unchanged_content(self, get, head, enqueue):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        enqueue.reset_mock()
+
+        get.return_value = responses(200, 'sw-all.xml')
+        UniqueFeed.objects.update_feed(feed.url)
+        fingerprint = UniqueFeed.objects.get().job_details['fingerprint']
+        self.assertEqual(enqueue.call_count, 1)
+
+        with patch('feedparser.parse') as parse:
+            UniqueFeed.objects.update_feed(feed.url,
+                                           fingerprint=fingerprint)
+        self.assertFalse(parse.called)
+        self.assertEqual(enqueue.call_count, 1)
+        counters = get_counters()
+        self.assertEqual(counters['fetch_parsed'], 1)
+        self.assertEqual(counters['fetch_unchanged'], 1)
+
+        # New subscribers get the entries stored
+        FeedFactory.create(url=feed.url)
+        self.assertNotIn('fingerprint', UniqueFeed.objects.get().job_details)
+
+        self.assertEqual(
+            content_fingerprint(b'<rss><channel>\n<lastBuildDate>1'
+                                b'</lastBuildDate><item>a</item>'),
+            content_fingerprint('<rss><channel><lastBuildDate>2'
+                                '</lastBuildDate>  <item>a</item>'))
+        self.assertNotEqual(
+            content_fingerprint(b'<feed><entry><updated>1</updated>'),
+            content_fingerprint(b'<feed><entry><updated>2</updated>'))
+
+    def test_new_entries(self):
+        parsed = feedparser.parse(data_file('sw-all.xml'))
+        entries, hwm, recent = UniqueFeed.objects.new_entries(parsed.entries)
+        self.assertEqual(len(entries), 30)
+        self.assertEqual(hwm, calendar.timegm((2020, 3, 12, 9, 28, 21)))
+        # Other entries are much older
+        self.assertEqual(recent, UniqueFeed.objects.entry_key(
+            parsed.entries[0]))
+
+        entries, new_hwm, new_recent = UniqueFeed.objects.new_entries(
+            parsed.entries, hwm, recent)
+        self.assertEqual(entries, [])
+        self.assertEqual((new_hwm, new_recent), (hwm, recent))
+
+        entries, new_hwm, new_recent = UniqueFeed.objects.new_entries(
+            parsed.entries, hwm)
+        self.assertEqual(entries, [parsed.entries[0]])
+
+        # Entries sharing a guid are told apart
+        self.assertNotEqual(
+            UniqueFeed.objects.entry_key({'id': 'guid', 'title': 'One'}),
+            UniqueFeed.objects.entry_key({'id': 'guid', 'title': 'Two'}))
+
+    @patch('feedhq.feeds.models.enqueue')
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_link_title_changes(self, get, head, enqueue):
+        head.side_effect = resolve_url
+        get.return_value = responses(200, 'sw-all.xml')
+        feed = FeedFactory.create()
+        user = feed.user
+
+        # Subscription lists get invalidated
+        version = user.version()
+        UniqueFeed.objects.update_feed(feed.url, link='http://example.com/',
+                                       title='Old title')
+        self.assertGreater(user.version(), version)
+
+        version = user.version()
+        UniqueFeed.objects.update_feed(feed.url,
+                                       link='http://simonwillison.net/',
+                                       title="Simon Willison's Weblog")
+        self.assertEqual(user.version(), version)
+
+    @patch('feedhq.feeds.models.enqueue')
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_high_water_mark(self, get, head, enqueue):
+        head.side_effect = resolve_url
+        get.return_value = responses(200, 'sw-all.xml')
+        feed = FeedFactory.create(user__ttl=99999)
+        enqueue.reset_mock()
+        UniqueFeed.objects.update_feed(feed.url)
+        [(args, kwargs)] = enqueue.call_args_list
+        self.assertEqual(len(kwargs['args'][1]), 30)
+        # The mark only moves once the entries are stored
+        self.assertNotIn('hwm', UniqueFeed.objects.get().job_details)
+
+        with patch('feedhq.es.bulk', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                store_entries(*kwargs['args'], **kwargs['kwargs'])
+        self.assertNotIn('hwm', UniqueFeed.objects.get().job_details)
+
+        store_entries(*kwargs['args'], **kwargs['kwargs'])
+        job = UniqueFeed.objects.get().job_details
+        self.assertEqual(job['hwm'], calendar.timegm((2020, 3, 12, 9, 28, 21)))
+
+        enqueue.reset_mock()
+        UniqueFeed.objects.update_feed(feed.url, hwm=job['hwm'],
+                                       recent=job['recent'])
+        self.assertFalse(enqueue.called)
+
+        # New subscribers get every entry
+        FeedFactory.create(url=feed.url)
+        job = UniqueFeed.objects.get().job_details
+        self.assertNotIn('hwm', job)
+        self.assertNotIn('recent', job)
+
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_seen_entries(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+
+        data = self.entries_data('sw-all.xml')
+        store_entries(feed.url, data)
+        redis = get_redis_connection()
+        self.assertEqual(redis.zcard(seen_key(feed.url)), 30)
+
+        with self.assertNumQueries(0):
+            store_entries(feed.url, data)
+
+        # A new subscriber gets the existing entries
+        feed2 = FeedFactory.create(url=feed.url, user__ttl=99999)
+        self.assertEqual(redis.zcard(seen_key(feed.url)), 0)
+        with self.assertNumQueries(2):
+            store_entries(feed.url, data)
+        self.assertEqual(self.counts(feed.user, all={})['all'], 30)
+        self.assertEqual(self.counts(feed2.user, all={})['all'], 30)
+
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_shared_content(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        feed2 = FeedFactory.create(url=feed.url, user__ttl=99999)
+
+        data = self.entries_data('sw-all.xml')
+        store_entries(feed.url, data)
+
+        self.assertEqual(es.client.count(
+            index=settings.ES_CONTENT_INDEX, doc_type='content')['count'], 30)
+
+        [raw] = es.client.search(index=es.user_alias(feed.user.pk),
+                                 doc_type='entries',
+                                 params={'size': 1})['hits']['hits']
+        self.assertNotIn('content', raw['_source'])
+        self.assertTrue(raw['_source']['content_id'])
+
+        [entry] = es.manager.user(feed2.user).fetch(per_page=1)['hits']
+        self.assertFalse(entry.content_pending)
+        self.assertTrue(entry.subtitle)
+
+        [entry] = es.manager.user(feed.user).defer('content').fetch(
+            per_page=1)['hits']
+        self.assertIsNone(entry.subtitle)
+
+        entry = es.entry(feed.user, entry.pk)
+        self.assertTrue(entry.content_pending)
+        self.assertTrue(entry.subtitle)
+
+        # Streamed responses load bodies a chunk at a time
+        entries = es.manager.user(feed.user).fetch(contents=False)['hits']
+        self.assertTrue(all(entry.content_pending for entry in entries))
+        with patch.object(es.client, 'mget', wraps=es.client.mget) as mget:
+            loaded = list(es.iter_contents(entries, chunk_size=20))
+        self.assertEqual(entries, [])
+        self.assertEqual(len(loaded), 30)
+        self.assertEqual(mget.call_count, 2)
+        self.assertFalse(any(entry.content_pending for entry in loaded))
+
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_shared_content_search(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        other = FeedFactory.create(user__ttl=99999)
+
+        data = self.entries_data('sw-all.xml')
+        store_entries(feed.url, data)
+
+        # Only the body mentions Sawzall
+        [entry] = es.manager.user(feed.user).filter(
+            query='sawzall').fetch()['hits']
+        self.assertTrue(entry.title.startswith('RE2'))
+        self.assertEqual(es.manager.user(other.user).filter(
+            query='sawzall').fetch()['hits'], [])
+
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_shared_content_purge(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        feed2 = FeedFactory.create(url=feed.url, user__ttl=99999)
+
+        data = self.entries_data('sw-all.xml')
+        store_entries(feed.url, data)
+
+        def count():
+            es.client.indices.refresh(settings.ES_CONTENT_INDEX)
+            return es.client.count(index=settings.ES_CONTENT_INDEX,
+                                   doc_type='content')['count']
+
+        # Still referenced by the other subscriber
+        feed.user.delete_feed_entries(feed.pk)
+        self.assertEqual(count(), 30)
+
+        feed2.user.delete_feed_entries(feed2.pk)
+        self.assertEqual(count(), 0)
+
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_sanitized_contents(self, get, head):
+        head.side_effect = resolve_url
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+
+        data = self.entries_data('sw-all.xml')
+        store_entries(feed.url, data)
+
+        [entry] = es.manager.user(feed.user).fetch(per_page=1)['hits']
+        content = es.contents([entry.content_id])[entry.content_id]
+        self.assertEqual(content['url'], feed.url)
+        self.assertEqual(content['sanitized_version'],
+                         EsEntry.SANITIZE_VERSION)
+        self.assertEqual(set(content['sanitized']), {'full', 'nomedia'})
+
+        # Displaying an entry is a plain read
+        entry = es.entry(feed.user, entry.pk)
+        with patch.object(Sanitizer, 'clean') as clean:
+            self.assertEqual(entry.sanitized_content(),
+                             content['sanitized']['full'])
+            self.assertEqual(entry.sanitized_nomedia_content(),
+                             content['sanitized']['nomedia'])
+        self.assertFalse(clean.called)
+
+        # Outdated variants are ignored until re-rendered
+        with patch.object(BaseEntry, 'SANITIZE_VERSION', 2):
+            entry = es.entry(feed.user, entry.pk)
+            self.assertIsNone(entry.stored_sanitized())
+
+            call_command('sanitize_contents')
+            content = es.contents([entry.content_id])[entry.content_id]
+            self.assertEqual(content['sanitized_version'], 2)
+            entry = es.entry(feed.user, entry.pk)
+            self.assertEqual(entry.stored_sanitized(), content['sanitized'])
+
+            # Failed updates are reported
+            error = {'update': {'_id': entry.content_id, 'status': 404}}
+            with patch('feedhq.es.bulk', return_value=(0, [error])):
+                with self.assertRaises(CommandError) as context:
+                    call_command('sanitize_contents', all=True)
+            self.assertIn('1 bodies', str(context.exception))
+
     @patch('requests.head')
     @patch('requests.get')
     def test_same_guids(self, get, head):
@@ -242,12 +735,10 @@ class UpdateTests(TestCase):
                 entry, parsed) for entry in parsed.entries]
         ))
 
-        with self.assertNumQueries(1 + len(data)):
+        with self.assertNumQueries(2):
             store_entries(feed.url, data)
 
-        count = es.counts(
-            feed.user, [feed.pk],
-            unread=False)[str(feed.pk)][str(feed.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
         self.assertEqual(count, 4)
 
         data = list(filter(
@@ -255,11 +746,9 @@ class UpdateTests(TestCase):
             [UniqueFeed.objects.entry_data(
                 entry, parsed) for entry in parsed.entries]
         ))
-        with self.assertNumQueries(1):
+        with self.assertNumQueries(0):  # all seen
             store_entries(feed.url, data)
-        count = es.counts(
-            feed.user, [feed.pk],
-            unread=False)[str(feed.pk)][str(feed.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
         self.assertEqual(count, 4)
 
         parsed = feedparser.parse(data_file('aldaily-06-30.xml'))
@@ -269,14 +758,45 @@ class UpdateTests(TestCase):
                 entry, parsed) for entry in parsed.entries]
         ))
 
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(2):
             store_entries(feed.url, data)
 
-        count = es.counts(
-            feed.user, [feed.pk],
-            unread=False)[str(feed.pk)][str(feed.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
         self.assertEqual(count, 10)
 
+    @patch('feedhq.feeds.models.enqueue')
+    @patch('requests.head')
+    @patch('requests.get')
+    def test_same_guids_single_new_entry(self, get, head, enqueue):
+        head.side_effect = resolve_url
+        get.return_value = responses(200, 'aldaily-06-27.xml')
+        feed = FeedFactory.create(user__ttl=99999)
+        enqueue.reset_mock()
+        UniqueFeed.objects.update_feed(feed.url)
+        [(args, kwargs)] = enqueue.call_args_list
+        store_entries(*kwargs['args'], **kwargs['kwargs'])
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
+        self.assertEqual(count, 4)
+
+        # A single new entry past the mark, sharing the feed's guid
+        with open(data_file('aldaily-06-27.xml'), 'rb') as f:
+            xml = f.read().decode('utf-8').replace('<item>', (
+                '<item><title>A new entry</title>'
+                '<link>http://www.aldaily.com</link>'
+                '<pubDate>Fri, 28 Jun 2013 02:00:00 +0000</pubDate>'
+                '<description>New</description></item><item>'), 1)
+        get.return_value = responses(200, data=xml)
+        job = UniqueFeed.objects.get().job_details
+        enqueue.reset_mock()
+        UniqueFeed.objects.update_feed(feed.url, hwm=job['hwm'],
+                                       recent=job['recent'])
+        [(args, kwargs)] = enqueue.call_args_list
+        self.assertEqual(len(kwargs['args'][1]), 1)
+        self.assertTrue(kwargs['kwargs']['filter_by_title'])
+        store_entries(*kwargs['args'], **kwargs['kwargs'])
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
+        self.assertEqual(count, 5)
+
     @patch("requests.head")
     @patch("requests.get")
     def test_empty_guid(self, get, head):
@@ -353,6 +873,69 @@ class UpdateTests(TestCase):
         secs = timedelta_to_seconds(UniqueFeed.objects.get().schedule_in)
         self.assertTrue(secs > 10000)
 
+    @patch("requests.head")
+    @patch("requests.get")
+    def test_adaptive_schedule(self, get, head):
+        get.return_value = responses(304)
+        head.side_effect = resolve_url
+        f = FeedFactory.create()
+        get.return_value = responses(200, 'sw-all.xml')
+        UniqueFeed.objects.update_feed(f.url)
+        unique = UniqueFeed.objects.get()
+        arrivals = UniqueFeed.parse_arrivals(unique.job_details['arrivals'])
+        self.assertTrue(UniqueFeed.ARRIVALS_MIN <= len(arrivals) <=
+                        UniqueFeed.ARRIVALS_HISTORY)
+        # Old entries, the feed is quiet
+        secs = timedelta_to_seconds(unique.schedule_in)
+        self.assertTrue(secs > 3600 * 23)
+
+        self.assertEqual(UniqueFeed.parse_arrivals(None), [])
+        self.assertEqual(UniqueFeed.parse_arrivals(12), [12])
+        self.assertEqual(UniqueFeed.parse_arrivals('1,2'), [1, 2])
+        self.assertIsNone(UniqueFeed.format_arrivals([]))
+        now = timezone.now()
+        merged = UniqueFeed.merge_arrivals(list(range(30)), [now, now])
+        self.assertEqual(len(merged), UniqueFeed.ARRIVALS_HISTORY)
+        self.assertEqual(merged[-1], int(now.timestamp()))
+
+    def test_adaptive_delay(self):
+        now = int(time.time())
+        hour = 3600
+        floor = UniqueFeed.UPDATE_PERIOD * 60
+
+        # Not enough history
+        self.assertEqual(UniqueFeed.adaptive_delay([now], now=now), floor)
+        # One entry every 8 hours, polled every 4 hours
+        arrivals = [now - 8 * hour * i for i in range(5)]
+        self.assertEqual(UniqueFeed.adaptive_delay(arrivals, now=now),
+                         4 * hour)
+        # Popular feeds are polled more often
+        self.assertEqual(UniqueFeed.adaptive_delay(arrivals, 10, now=now),
+                         2 * hour)
+        # Bounds
+        arrivals = [now - 60 * i for i in range(5)]
+        self.assertEqual(UniqueFeed.adaptive_delay(arrivals, now=now), floor)
+        arrivals = [now - 30 * 24 * hour * i for i in range(5)]
+        self.assertEqual(UniqueFeed.adaptive_delay(arrivals, now=now),
+                         UniqueFeed.ADAPTIVE_MAX_DELAY)
+        # Quiet feed
+        arrivals = [now - 10 * 24 * hour - hour * i for i in range(5)]
+        self.assertEqual(UniqueFeed.adaptive_delay(arrivals, now=now),
+                         UniqueFeed.ADAPTIVE_MAX_DELAY)
+
+        # Daily entries published around the same time
+        arrivals = [now + 2 * hour - 24 * hour * i for i in range(1, 15)]
+        active = UniqueFeed.adaptive_delay(arrivals, now=now)
+        arrivals = [now + 12 * hour - 24 * hour * i for i in range(1, 15)]
+        inactive = UniqueFeed.adaptive_delay(arrivals, now=now)
+        self.assertEqual(active, 6 * hour)
+        self.assertEqual(inactive, UniqueFeed.ADAPTIVE_MAX_DELAY)
+
+        self.assertEqual(
+            timedelta_to_seconds(UniqueFeed.delay(1, arrivals=arrivals)),
+            UniqueFeed.ADAPTIVE_MAX_DELAY)
+        self.assertEqual(timedelta_to_seconds(UniqueFeed.delay(1)), floor)
+
     def test_clean_rq(self):
         r = get_redis_connection()
         self.assertEqual(len(r.keys('rq:job:*')), 0)